@@ -0,0 +1,108 @@
+"""
+Rendering Campbell-grams for many (sample, chromosome) pairs at once.
+
+Each sample's copy number and fusion files are read once, in the parent
+process, and split by chromosome. The inputs are handed to a pool of
+worker processes when the pool starts (on Linux the workers simply
+inherit them), and each job draws on its own Agg figure, without pyplot.
+A failing job does not stop the others: its traceback is returned in
+its result.
+
+    samples = {"ST059": ("ST059_cn.bed", "ST059_breakpoints.txt")}
+    results = batch.render_batch(samples, ["chr%s" % c for c in range(1, 23)],
+                                 "plots/%(sample)s_%(chrom)s.pdf",
+                                 logbase = 4)
+    failed = [r for r in results if r.error != None]
+"""
+
+import itertools as it
+import multiprocessing
+import traceback
+from collections import namedtuple
+
+import sv_data
+import sv_diagram as sv_d
+
+JobResult = namedtuple('JobResult', ['sample', 'chrom', 'outfile', 'error'])
+
+### Inputs ###
+
+class SampleData(object):
+    """Copy number and fusions of one sample, split by chromosome."""
+
+    def __init__(self, cn_file, fusion_file):
+        cn_data = sv_data.df_from_bed(cn_file)
+        self.cn = dict((chrom, (group['start'].values, group['CN'].values))
+                       for chrom, group in cn_data.groupby('chrom'))
+        self.fusions = sv_data.FusionTable.from_file(fusion_file)
+
+    def x_cn(self, chrom):
+        return self.cn[chrom]
+
+    def fusion_table(self, chrom):
+        return self.fusions.on_chrom(chrom)
+
+def load_samples(samples):
+    """Reads the inputs of samples, a dict mapping sample names to
+       (cn_file, fusion_file) pairs."""
+    return dict((name, SampleData(cn_file, fusion_file))
+                for name, (cn_file, fusion_file) in samples.items())
+
+# Set in each worker (and in the parent, for serial runs).
+shared_samples = {}
+
+def share_samples(samples):
+    global shared_samples
+    shared_samples = samples
+
+### Jobs ###
+
+def render_sv_diagram(x, cn, fusions, outfile, **kwargs):
+    """As sv_diagram.plot_sv_diagram, but on a figure outside pyplot."""
+    fig = sv_d.setup_figure(pyplot = False)
+    sv_d.draw_sv_diagram(fig, x, cn, fusions, **kwargs)
+    fig.savefig(outfile)
+
+def render_job(job):
+    """Renders one (sample, chrom, outfile, kwargs) job from the shared
+       samples, returning a JobResult."""
+    sample, chrom, outfile, kwargs = job
+    try:
+        data = shared_samples[sample]
+        x, cn = data.x_cn(chrom)
+        kwargs = dict(kwargs)
+        kwargs.setdefault("xlabel", "Position on %s (Mb)" % chrom)
+        render_sv_diagram(x, cn, data.fusion_table(chrom), outfile, **kwargs)
+        return JobResult(sample, chrom, outfile, None)
+    except Exception:
+        return JobResult(sample, chrom, outfile, traceback.format_exc())
+
+def render_batch(samples, chroms, outfile_pattern, processes = None,
+                 **kwargs):
+    """Renders a Campbell-gram for every sample and chromosome.
+
+       samples maps sample names to (cn_file, fusion_file) pairs;
+       outfile_pattern is filled in with %(sample)s and %(chrom)s.
+       Key word arguments are passed on as in plot_sv_diagram.
+       processes = 1 renders in this process; None uses one process per
+       CPU. Returns a list of JobResults, in (sample, chrom) order."""
+
+    jobs = [(sample, chrom,
+             outfile_pattern % {'sample': sample, 'chrom': chrom},
+             kwargs)
+            for sample, chrom in it.product(sorted(samples), chroms)]
+    loaded = load_samples(samples)
+
+    if processes == 1:
+        share_samples(loaded)
+        return [render_job(job) for job in jobs]
+
+    pool = multiprocessing.Pool(processes,
+                                initializer = share_samples,
+                                initargs = (loaded,))
+    try:
+        results = pool.map(render_job, jobs, chunksize = 1)
+    finally:
+        pool.close()
+        pool.join()
+    return results
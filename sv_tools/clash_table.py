@@ -0,0 +1,235 @@
+"""
+A precomputed table of identifiability classes.
+
+For every rearrangement of a base chromosome such as "ABCDEFG", the
+table holds the id and size of its clash class: the rearrangements with
+the same sv_diagram_data (see identifiability). A rearrangement is
+identifiable from its diagram when its class has size 1.
+
+Rearrangements are packed into integer keys and stored in an open
+addressing hash table, saved as .npy files and memory-mapped, so a
+lookup reads a few slots whatever the size of the table. Build a table
+with
+
+    python clash_table.py ABCDEFG tables/ABCDEFG
+
+(which uses sweep.run_sweep, and can resume), then
+
+    table = clash_table.ClashTable("tables/ABCDEFG")
+    identifiability.ChromString("CAB'").clash_class(table)
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+
+import numpy as np
+
+import identifiability as idf
+import sweep
+
+format_version = 2
+
+# Multiplier for Fibonacci hashing: 2**64 divided by the golden ratio.
+multiplier = 0x9E3779B97F4A7C15
+mask64 = (1 << 64) - 1
+
+### Keys ###
+
+class KeyPacker(object):
+    """Packs canonical signed segment tuples of a base chromosome into
+       integers: one digit per segment, after a leading 1."""
+
+    def __init__(self, offset, width):
+        self.offset = offset
+        self.width = width
+        self.base = 2 * width + 1
+
+    @staticmethod
+    def for_values(values):
+        numbers = [abs(v) for v in values]
+        offset = min(numbers) - 1 if numbers else 0
+        width = max(numbers) - offset if numbers else 1
+        return KeyPacker(offset, width)
+
+    def max_length(self):
+        """Longest tuple whose key fits in 63 bits."""
+        return int(63 / np.log2(self.base)) - 1
+
+    def pack(self, values):
+        """The key of a tuple, or None if it has segments outside the
+           base's range."""
+        key = 1
+        for v in values:
+            digit = abs(v) - self.offset
+            if not 1 <= digit <= self.width:
+                return None
+            if v < 0:
+                digit += self.width
+            key = key * self.base + digit
+        return key
+
+def home_slots(keys, bits):
+    """Fibonacci hash of an array of keys, to 2**bits slots."""
+    product = keys.astype(np.uint64) * np.uint64(multiplier)
+    return (product >> np.uint64(64 - bits)).astype(np.int64)
+
+def home_slot(key, bits):
+    return ((key * multiplier) & mask64) >> (64 - bits)
+
+### Building ###
+
+def hash_table(keys, values, bits):
+    """Open addressing (linear probing) table of 2**bits slots holding
+       keys (which must be non-zero and distinct) and their values."""
+    capacity = 1 << bits
+    slot_keys = np.zeros(capacity, dtype = np.int64)
+    slot_values = np.zeros(capacity, dtype = np.int64)
+
+    home = home_slots(keys, bits)
+    probe = np.zeros(len(keys), dtype = np.int64)
+    pending = np.arange(len(keys))
+    while len(pending):
+        slot = (home[pending] + probe[pending]) & (capacity - 1)
+        free = slot_keys[slot] == 0
+        # Of the keys trying the same free slot, the first takes it.
+        candidates, candidate_slots = pending[free], slot[free]
+        _, first = np.unique(candidate_slots, return_index = True)
+        winners = candidates[first]
+        slot_keys[candidate_slots[first]] = keys[winners]
+        slot_values[candidate_slots[first]] = values[winners]
+
+        placed = np.zeros(len(keys), dtype = bool)
+        placed[winners] = True
+        pending = pending[~placed[pending]]
+        probe[pending] += 1
+    return slot_keys, slot_values
+
+def build_table(chrom_string, directory, processes = None,
+                progress = sys.stderr):
+    """Builds the table of all rearrangements of chrom_string in
+       directory, finding clash classes with sweep.run_sweep (whose
+       shards are kept in directory/sweep, so building can resume)."""
+    chrom_code = idf.ChromCode.from_string(chrom_string)
+    packer = KeyPacker.for_values(chrom_code.values)
+    if len(chrom_code) > packer.max_length():
+        raise ValueError("%s is too long for a table" % chrom_string)
+
+    result = sweep.run_sweep(chrom_code, os.path.join(directory, "sweep"),
+                             processes = processes, progress = progress)
+    class_of = {}
+    class_sizes = []
+    for members in result.classes:
+        for code in members:
+            class_of[code.values] = len(class_sizes)
+        class_sizes.append(len(members))
+
+    # Every other rearrangement is in a class of its own.
+    keys = np.zeros(result.n_rearrangements, dtype = np.int64)
+    classes = np.zeros(result.n_rearrangements, dtype = np.int64)
+    for i, code in enumerate(idf.iter_rearrangements(chrom_code)):
+        keys[i] = packer.pack(code.values)
+        if code.values in class_of:
+            classes[i] = class_of[code.values]
+        else:
+            classes[i] = len(class_sizes)
+            class_sizes.append(1)
+
+    bits = max(int(np.ceil(np.log2(2 * max(len(keys), 1)))), 1)
+    slot_keys, slot_classes = hash_table(keys, classes, bits)
+    np.save(os.path.join(directory, "slot_keys.npy"), slot_keys)
+    np.save(os.path.join(directory, "slot_classes.npy"), slot_classes)
+    np.save(os.path.join(directory, "class_sizes.npy"),
+            np.array(class_sizes, dtype = np.int64))
+
+    meta = {'version': format_version,
+            'base': chrom_code.string,
+            'counts': segment_counts(chrom_code.values),
+            'offset': packer.offset,
+            'width': packer.width,
+            'bits': bits,
+            'n_rearrangements': len(keys),
+            'n_classes': len(class_sizes)}
+    # Written last, and atomically: a table without it is incomplete.
+    handle, temporary = tempfile.mkstemp(dir = directory)
+    with os.fdopen(handle, 'w') as f:
+        json.dump(meta, f)
+    os.rename(temporary, os.path.join(directory, "table.json"))
+
+def segment_counts(values):
+    counts = {}
+    for v in values:
+        counts[str(abs(v))] = counts.get(str(abs(v)), 0) + 1
+    return counts
+
+### Querying ###
+
+class ClashTable(object):
+    """A table written by build_table, read through memory maps."""
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, "table.json")) as f:
+            meta = json.load(f)
+        if meta['version'] != format_version:
+            raise ValueError("%s has an old table format" % directory)
+        self.base = meta['base']
+        self.counts = dict((int(k), v) for k, v in meta['counts'].items())
+        self.packer = KeyPacker(meta['offset'], meta['width'])
+        self.bits = meta['bits']
+        self.n_classes = meta['n_classes']
+
+        def load(name):
+            return np.load(os.path.join(directory, name), mmap_mode = 'r')
+
+        self.slot_keys = load("slot_keys.npy")
+        self.slot_classes = load("slot_classes.npy")
+        self.class_sizes = load("class_sizes.npy")
+
+    def covers(self, chrom_code):
+        """Whether chrom_code is a rearrangement of the base."""
+        used = {}
+        for v in chrom_code.values:
+            used[abs(v)] = used.get(abs(v), 0) + 1
+        return all(n <= self.counts.get(s, 0) for s, n in used.items())
+
+    def lookup(self, chrom_code):
+        """(class id, class size) of a ChromCode (with letters numbered
+           by ord, as ChromCode.from_string does), or None if it is not
+           a rearrangement of the base."""
+        if not self.covers(chrom_code):
+            return None
+        key = self.packer.pack(chrom_code.values)
+        if key == None:
+            return None
+        mask = len(self.slot_keys) - 1
+        slot = home_slot(key, self.bits)
+        while True:
+            found = self.slot_keys[slot]
+            if found == key:
+                class_id = int(self.slot_classes[slot])
+                return class_id, int(self.class_sizes[class_id])
+            elif found == 0:
+                return None
+            slot = (slot + 1) & mask
+
+### Command line ###
+
+def main(args):
+    parser = argparse.ArgumentParser(
+                description = "Builds a table of the identifiability "
+                              "classes of all rearrangements of a "
+                              "chromosome, such as ABCDEFG.")
+    parser.add_argument("chromosome")
+    parser.add_argument("directory")
+    parser.add_argument("--processes", type = int, default = None,
+                        help = "worker processes (default: one per CPU)")
+    options = parser.parse_args(args)
+
+    if not os.path.isdir(options.directory):
+        os.makedirs(options.directory)
+    build_table(options.chromosome, options.directory, options.processes)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,127 @@
+"""
+Copy number on either side of breakpoints and fusions.
+
+Copy number bins (a data frame with chrom, start, end and CN columns, as
+returned by sv_data.df_from_bed) are sorted once into a single genome-wide
+order, and all breakpoints are located in it with one np.searchsorted
+call. The bin containing a breakpoint is ambiguous and is skipped: the
+left CN is taken from bins ending at or before the breakpoint, the right
+CN from bins starting at or after it. With flank > 1 these are averages
+over up to flank bins, computed from cumulative sums.
+"""
+
+import numpy as np
+import pandas as pd
+
+import sv_data
+
+def genome_order(chrom_codes, positions):
+    """Position in a genome-wide coordinate, chromosome by chromosome.
+       Positions must fit in 32 bits."""
+    return (np.asarray(chrom_codes, dtype = np.int64) << 32) + \
+           np.asarray(positions, dtype = np.int64)
+
+class CNBins(object):
+    """Copy number bins of all chromosomes, in genome order."""
+
+    def __init__(self, cn_data):
+        chrom_codes, chroms = pd.factorize(cn_data['chrom'], sort = True)
+        starts = cn_data['start'].values
+        order = np.argsort(genome_order(chrom_codes, starts),
+                           kind = 'mergesort')
+
+        self.chroms = list(chroms)
+        self.chrom_codes = chrom_codes[order]
+        self.starts = genome_order(self.chrom_codes, starts[order])
+        self.ends = genome_order(self.chrom_codes, cn_data['end'].values[order])
+        self.cn = cn_data['CN'].values[order].astype(float)
+        self.cumulative_cn = np.concatenate([[0.], np.cumsum(self.cn)])
+
+        # First and last (exclusive) bin of each chromosome.
+        codes = np.arange(len(self.chroms))
+        self.chrom_first = np.searchsorted(self.chrom_codes, codes, 'left')
+        self.chrom_last = np.searchsorted(self.chrom_codes, codes, 'right')
+
+    @staticmethod
+    def from_file(filename):
+        return CNBins(sv_data.df_from_bed(filename))
+
+    def codes_of(self, chroms):
+        """Chromosome codes; -1 for chromosomes without bins."""
+        code = dict((c, i) for i, c in enumerate(self.chroms))
+        return np.array([code.get(c, -1) for c in chroms], dtype = np.int64)
+
+    def mean_cn(self, first, last):
+        """Mean CN of bins first:last, NaN where the range is empty."""
+        n = last - first
+        total = self.cumulative_cn[last] - self.cumulative_cn[first]
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            return np.where(n > 0, total / np.maximum(n, 1), np.nan)
+
+    def left_right_cn(self, chroms, positions, flank = 1):
+        """Arrays of the CN left and right of each position."""
+        codes = self.codes_of(chroms)
+        known = codes >= 0
+        safe_codes = np.where(known, codes, 0)
+        where = genome_order(safe_codes, positions)
+
+        # Bins ending at or before the position, starting at or after it.
+        left_end = np.searchsorted(self.ends, where, side = 'right')
+        right_start = np.searchsorted(self.starts, where, side = 'left')
+
+        chrom_first = self.chrom_first[safe_codes]
+        chrom_last = self.chrom_last[safe_codes]
+        left_end = np.clip(left_end, chrom_first, chrom_last)
+        right_start = np.clip(right_start, chrom_first, chrom_last)
+        left_start = np.maximum(left_end - flank, chrom_first)
+        right_end = np.minimum(right_start + flank, chrom_last)
+
+        left = np.where(known, self.mean_cn(left_start, left_end), np.nan)
+        right = np.where(known, self.mean_cn(right_start, right_end), np.nan)
+        return left, right
+
+def annotate_positions(cn_bins, chroms, positions, strands, flank = 1):
+    """Data frame of left_cn, right_cn, cn_change (right minus left), and
+       joined_cn: the CN on the side of the breakpoint that is joined in
+       the fusion (left for '+', right for '-')."""
+    left, right = cn_bins.left_right_cn(chroms, positions, flank)
+    plus = np.asarray(strands) == '+'
+    return pd.DataFrame({'left_cn': left,
+                         'right_cn': right,
+                         'cn_change': right - left,
+                         'joined_cn': np.where(plus, left, right)},
+                        columns = ['left_cn', 'right_cn',
+                                   'cn_change', 'joined_cn'])
+
+def annotate_breakpoints(breakpoints, cn_bins, flank = 1):
+    """Annotates a list of Breakpoints (or a data frame with chrom, pos
+       and strand columns) with the CN on either side."""
+    if isinstance(breakpoints, pd.DataFrame):
+        data = breakpoints[['chrom', 'pos', 'strand']].reset_index(drop = True)
+    else:
+        data = pd.DataFrame({'chrom': [bp.chrom for bp in breakpoints],
+                             'pos': [bp.pos for bp in breakpoints],
+                             'strand': [bp.strand for bp in breakpoints]},
+                            columns = ['chrom', 'pos', 'strand'])
+    cn = annotate_positions(cn_bins, data['chrom'].values,
+                            data['pos'].values, data['strand'].values, flank)
+    return pd.concat([data, cn], axis = 1)
+
+def annotate_fusions(fusions, cn_bins, flank = 1):
+    """Annotates a list of Fusions (or a FusionTable) with the CN either
+       side of both breakpoints (columns suffixed 1 and 2), in one pass
+       over all chromosomes."""
+    data = sv_data.FusionTable.from_fusions(fusions).data
+    data = data[sv_data.FusionTable.columns + ['type']]
+    n = len(data)
+
+    # Both ends at once.
+    chroms = np.concatenate([data['chrom1'].values, data['chrom2'].values])
+    positions = np.concatenate([data['pos1'].values, data['pos2'].values])
+    strands = np.concatenate([data['strand1'].values,
+                              data['strand2'].values])
+    cn = annotate_positions(cn_bins, chroms, positions, strands, flank)
+
+    ends = [cn.iloc[:n].reset_index(drop = True).add_suffix('1'),
+            cn.iloc[n:].reset_index(drop = True).add_suffix('2')]
+    return pd.concat([data] + ends, axis = 1)
@@ -0,0 +1,167 @@
+"""
+Multi-resolution copy number summaries, for zoomable diagrams.
+
+Level 0 of a pyramid is the copy number bins themselves; each further
+level merges factor consecutive bins of the level below (within a
+chromosome), keeping their mean, min and max CN. Levels are stored on
+disk as sidecars (see sidecar.py), one per level, and read through
+memory maps, so a query only touches the window it asks for, at the
+coarsest level that still has a point per output pixel. The pyramid is
+rebuilt when its source file changes.
+"""
+
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+import sidecar
+import sv_data
+
+fields = ['x', 'mean', 'min', 'max', 'count']
+
+# setup_figure's default width, 3.5 inches at 1000 dpi.
+default_pixels = 3500
+
+### Building ###
+
+def coarsen(chrom_codes, columns, factor):
+    """Merges each run of factor consecutive bins of a chromosome.
+       Bins must be sorted by chromosome and position."""
+    n = len(chrom_codes)
+    index = np.arange(n)
+    chrom_start = np.searchsorted(chrom_codes, chrom_codes, side = 'left')
+    group_starts = index[(index - chrom_start) % factor == 0]
+
+    count = np.add.reduceat(columns['count'], group_starts)
+    total = np.add.reduceat(columns['mean'] * columns['count'], group_starts)
+    coarse = {'x': columns['x'][group_starts],
+              'mean': total / count,
+              'min': np.minimum.reduceat(columns['min'], group_starts),
+              'max': np.maximum.reduceat(columns['max'], group_starts),
+              'count': count}
+    return chrom_codes[group_starts], coarse
+
+def build_pyramid(cn_data, directory, stamp, factor = 4, min_bins = 256):
+    """Writes the levels of a pyramid for cn_data (a data frame as from
+       sv_data.df_from_bed) to directory. Levels are added until no
+       chromosome has more than min_bins bins."""
+    chrom_codes, chroms = pd.factorize(cn_data['chrom'], sort = True)
+    order = np.lexsort((cn_data['start'].values, chrom_codes))
+    chrom_codes = chrom_codes[order]
+    cn = cn_data['CN'].values[order].astype(float)
+    columns = {'x': cn_data['start'].values[order].astype(np.int64),
+               'mean': cn, 'min': cn, 'max': cn,
+               'count': np.ones(len(cn), dtype = np.int64)}
+    chroms = np.asarray(chroms).astype(str)
+
+    level = 0
+    while True:
+        sidecar.write_sidecar(level_dir(directory, level), stamp,
+                              chroms[chrom_codes], columns)
+        largest = np.bincount(chrom_codes).max() if len(chrom_codes) else 0
+        if largest <= min_bins:
+            break
+        chrom_codes, columns = coarsen(chrom_codes, columns, factor)
+        level += 1
+
+    meta = dict(stamp)
+    meta['factor'] = factor
+    meta['levels'] = level + 1
+    with open(os.path.join(directory, "pyramid.json"), 'w') as f:
+        json.dump(meta, f)
+
+def level_dir(directory, level):
+    return os.path.join(directory, "level_%d" % level)
+
+### Querying ###
+
+class CNPyramid(object):
+    """A copy number pyramid on disk. Create with CNPyramid.for_file."""
+
+    def __init__(self, directory, stamp):
+        with open(os.path.join(directory, "pyramid.json")) as f:
+            meta = json.load(f)
+        self.directory = directory
+        self.factor = meta['factor']
+        self.levels = meta['levels']
+        self.indexes = [sidecar.read_index(level_dir(directory, level), stamp)
+                        for level in range(self.levels)]
+
+    @staticmethod
+    def for_file(cn_file, cache_dir = None, factor = 4):
+        """The pyramid of a copy number .bed file, built on first use
+           (next to the file, or in cache_dir) and whenever the file
+           changes."""
+        directory = sidecar.sidecar_dir(cn_file, 'pyramid', cache_dir)
+        stamp = sidecar.source_stamp(cn_file)
+        try:
+            pyramid = CNPyramid(directory, stamp)
+            if (pyramid.factor == factor and
+                    all(index != None for index in pyramid.indexes)):
+                return pyramid
+        except (IOError, OSError, ValueError):
+            pass
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        build_pyramid(sv_data.df_from_bed(cn_file), directory, stamp, factor)
+        return CNPyramid(directory, stamp)
+
+    def level_column(self, level, chrom, field):
+        """Memory-mapped column of one level and chromosome."""
+        start, stop = self.indexes[level]['chroms'].get(str(chrom), (0, 0))
+        mapped = np.load(os.path.join(level_dir(self.directory, level),
+                                      field + ".npy"),
+                         mmap_mode = 'r')
+        return mapped[start:stop]
+
+    def choose_level(self, chrom, xmin, xmax, n_pixels):
+        """The coarsest level with at least n_pixels points between xmin
+           and xmax."""
+        x = self.level_column(0, chrom, 'x')
+        n_bins = (np.searchsorted(x, xmax, side = 'right') -
+                  np.searchsorted(x, xmin, side = 'left'))
+        if n_bins <= n_pixels:
+            return 0
+        level = int(np.log(n_bins / float(n_pixels)) / np.log(self.factor))
+        return min(level, self.levels - 1)
+
+    def window(self, chrom, xmin, xmax, n_pixels = default_pixels,
+               level = None):
+        """Summary of chrom between xmin and xmax (in bp), at the level
+           matching n_pixels unless a level is given: a dict of x, mean,
+           min, max and count arrays (views of the memory maps)."""
+        if level == None:
+            level = self.choose_level(chrom, xmin, xmax, n_pixels)
+        x = self.level_column(level, chrom, 'x')
+        # Include the bin overlapping xmin.
+        lo = max(np.searchsorted(x, xmin, side = 'right') - 1, 0)
+        hi = np.searchsorted(x, xmax, side = 'right')
+        window = dict((field, self.level_column(level, chrom, field)[lo:hi])
+                      for field in fields)
+        window['level'] = level
+        return window
+
+    def x_cn(self, chrom, xmin, xmax, n_pixels = default_pixels):
+        """x and CN points for plotting: the mean, min and max of each
+           summary bin (just the CN at full resolution)."""
+        window = self.window(chrom, xmin, xmax, n_pixels)
+        if window['level'] == 0:
+            return np.asarray(window['x']), np.asarray(window['mean'])
+        x = np.concatenate([window['x']] * 3)
+        cn = np.concatenate([window['mean'], window['min'], window['max']])
+        return x, cn
+
+### Plotting ###
+
+def plot_zoomed_sv_diagram(pyramid, chrom, fusions, outfile, xmin, xmax,
+                           n_pixels = default_pixels, **kwargs):
+    """sv_diagram.plot_sv_diagram between xmin and xmax (in bp), reading
+       copy number from a CNPyramid at the matching resolution."""
+    import sv_diagram as sv_d
+    x, cn = pyramid.x_cn(chrom, xmin, xmax, n_pixels)
+    kwargs['xmin'] = xmin / 1e6
+    kwargs['xmax'] = xmax / 1e6
+    sv_d.plot_sv_diagram(x, cn, fusions, outfile, **kwargs)
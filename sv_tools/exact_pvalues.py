@@ -0,0 +1,270 @@
+"""
+Exact and Monte Carlo p-values for Tests E1 and F.
+
+kc_tests.chisq_test and kc_tests.modified_wald_wolfowitz use chi-square
+and normal approximations, which are poor for the few fusions of a
+single chromosome. Here p-values come from the null distributions
+themselves:
+
+-   Test E1: under the null, each of N fusions is of one of the four
+    types with equal probability. The chi-square statistic is
+    4 * sum(count**2) / N - N, so fusions are compared by sum(count**2).
+    Its distribution is found exactly, by going through every split of
+    N into four counts, or, when there are too many splits, from
+    Monte Carlo samples of the multinomial.
+-   Test F: under the null, the N_1 heads and N_2 tails of a walk are in
+    random order. A walk with R runs of equal letters has N - R + 1
+    alternating runs (see kc_tests.alternating_runs), and the
+    distribution of R has a closed form. Monte Carlo samples of random
+    walks can be used instead.
+
+Null distributions are cached by an engine, per N for Test E1 and per
+(N_1, N_2) for Test F, so testing a cohort computes each only once.
+Monte Carlo replicates are made in chunks, each with its own random
+stream seeded by the seed, the test, its counts and the chunk number, so
+results depend on the seed but not on the number of processes or the
+order of calls.
+
+    engine = exact_pvalues.PValueEngine(seed = 1)
+    engine.e1_pvalue(kc_tests.fusion_type_counts(fusions))
+    runs, heads, tails = kc_tests.alternating_run_counts(walks)
+    engine.f_pvalue(runs, heads, tails)
+"""
+
+import math
+import multiprocessing
+
+import numpy as np
+
+import null_model
+
+### Null distributions ###
+
+class NullDistribution(object):
+    """A discrete null distribution: the weights of sorted values. Exact
+       distributions have probabilities as weights; Monte Carlo ones
+       have counts of replicates."""
+
+    def __init__(self, values, weights, exact):
+        self.values = np.asarray(values)
+        self.weights = np.asarray(weights, dtype = float)
+        self.exact = exact
+        self.total = self.weights.sum()
+        self.cumulative = np.concatenate([[0.], np.cumsum(self.weights)])
+
+    @staticmethod
+    def from_samples(samples):
+        values, counts = np.unique(samples, return_counts = True)
+        return NullDistribution(values, counts, False)
+
+    def pvalue(self, observed, alternative = 'greater'):
+        """Probability of a value at least as large ('greater') or at
+           most as large ('less') as observed (a number or an array).
+           Monte Carlo p-values count the observation itself, as
+           null_model.empirical_pvalue does."""
+        if alternative == 'greater':
+            index = np.searchsorted(self.values, observed, side = 'left')
+            extreme = self.total - self.cumulative[index]
+        elif alternative == 'less':
+            index = np.searchsorted(self.values, observed, side = 'right')
+            extreme = self.cumulative[index]
+        else:
+            raise ValueError("alternative must be 'greater' or 'less'")
+        if self.exact:
+            return np.clip(extreme, 0., 1.)
+        return (extreme + 1) / (self.total + 1)
+
+## Test E1 ##
+
+def e1_statistic(counts):
+    """sum(count**2) of each row of fusion type counts (or of a single
+       row), which orders the rows as the chi-square statistic does."""
+    counts = np.asarray(counts, dtype = np.int64)
+    return (counts ** 2).sum(axis = -1)
+
+def n_splits(n):
+    """Number of ways to split n fusions into four type counts."""
+    return (n + 1) * (n + 2) * (n + 3) // 6
+
+def exact_e1(n):
+    """Exact distribution of e1_statistic for n fusions."""
+    log_factorial = np.concatenate([[0.],
+                                    np.cumsum(np.log(np.arange(1, n + 1)))])
+    weights = np.zeros(n * n + 1)
+    for a in range(n + 1):
+        m = n - a
+        b, c = np.meshgrid(np.arange(m + 1), np.arange(m + 1),
+                           indexing = 'ij')
+        inside = b + c <= m
+        b, c = b[inside], c[inside]
+        d = m - b - c
+        log_p = (log_factorial[n] - log_factorial[a] - log_factorial[b] -
+                 log_factorial[c] - log_factorial[d] - n * math.log(4))
+        weights += np.bincount(a * a + b * b + c * c + d * d,
+                               weights = np.exp(log_p),
+                               minlength = n * n + 1)
+    values = np.flatnonzero(weights)
+    return NullDistribution(values, weights[values], True)
+
+def sample_e1(rng, n_replicates, n):
+    """e1_statistic of n_replicates multinomial samples of n fusions."""
+    return e1_statistic(rng.multinomial(n, [.25] * 4, size = n_replicates))
+
+## Test F ##
+
+def log_choose(n, k):
+    if k < 0 or k > n:
+        return -np.inf
+    return math.lgamma(n + 1) - math.lgamma(k + 1) - math.lgamma(n - k + 1)
+
+def exact_f(N_1, N_2):
+    """Exact distribution of the number of alternating runs of a walk of
+       N_1 heads and N_2 tails in random order."""
+    N = N_1 + N_2
+    if N_1 == 0 or N_2 == 0:
+        # Every letter is an alternating run of its own.
+        return NullDistribution([N], [1.], True)
+
+    # P(R runs of equal letters), for R = 2k and R = 2k + 1.
+    total = log_choose(N, N_1)
+    runs, weights = [], []
+    for k in range(1, min(N_1, N_2) + 1):
+        runs.append(2 * k)
+        weights.append(2 * math.exp(log_choose(N_1 - 1, k - 1) +
+                                    log_choose(N_2 - 1, k - 1) - total))
+        runs.append(2 * k + 1)
+        weights.append(math.exp(log_choose(N_1 - 1, k) +
+                                log_choose(N_2 - 1, k - 1) - total) +
+                       math.exp(log_choose(N_1 - 1, k - 1) +
+                                log_choose(N_2 - 1, k) - total))
+    alternating = N - np.array(runs) + 1
+    order = np.argsort(alternating)
+    return NullDistribution(alternating[order], np.array(weights)[order],
+                            True)
+
+def sample_f(rng, n_replicates, N_1, N_2):
+    """Alternating runs of n_replicates walks of N_1 heads and N_2 tails
+       in random order."""
+    N = N_1 + N_2
+    # Letter i of a walk is the order[i]-th letter, the first N_1 heads.
+    order = rng.rand(n_replicates, N).argsort(axis = 1)
+    is_head = order < N_1
+    _, _, runs = null_model.walk_statistics(
+                     is_head, np.ones(is_head.shape, dtype = bool))
+    return runs
+
+## Monte Carlo ##
+
+samplers = {'E1': sample_e1, 'F': sample_f}
+test_numbers = {'E1': 1, 'F': 2}
+
+def sample_chunk(job):
+    """Samples of one chunk of replicates, from its own random stream."""
+    seed, test, counts, chunk, n_replicates = job
+    rng = np.random.RandomState([seed, test_numbers[test]] + list(counts) +
+                                [chunk])
+    return samplers[test](rng, n_replicates, *counts)
+
+def monte_carlo(test, counts, n_replicates, seed = 0, chunk_size = 10000,
+                processes = 1):
+    """Monte Carlo NullDistribution of a test ('E1' with counts (n,),
+       or 'F' with counts (N_1, N_2)). processes = 1 runs in this
+       process; None uses one process per CPU."""
+    sizes = [min(chunk_size, n_replicates - start)
+             for start in range(0, n_replicates, chunk_size)]
+    jobs = [(seed, test, tuple(counts), chunk, size)
+            for chunk, size in enumerate(sizes)]
+
+    if processes == 1:
+        results = map(sample_chunk, jobs)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(sample_chunk, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    return NullDistribution.from_samples(np.concatenate(results))
+
+### Engine ###
+
+class PValueEngine(object):
+    """Computes and caches null distributions for Tests E1 and F.
+
+       method is 'exact', 'monte_carlo', or 'auto', which is exact for
+       Test F, and for Test E1 unless there are more than max_exact
+       splits of the fusions into types. n_replicates, seed, chunk_size
+       and processes are as for monte_carlo."""
+
+    def __init__(self, method = 'auto', n_replicates = 1000000, seed = 0,
+                 chunk_size = 10000, processes = 1, max_exact = 5000000):
+        if method not in ('auto', 'exact', 'monte_carlo'):
+            raise ValueError("method must be 'auto', 'exact' or "
+                             "'monte_carlo'")
+        self.method = method
+        self.n_replicates = n_replicates
+        self.seed = seed
+        self.chunk_size = chunk_size
+        self.processes = processes
+        self.max_exact = max_exact
+        self.cache = {}
+
+    def sample(self, test, counts):
+        return monte_carlo(test, counts, self.n_replicates, self.seed,
+                           self.chunk_size, self.processes)
+
+    def e1_null(self, n):
+        """NullDistribution of e1_statistic for n fusions."""
+        n = int(n)
+        key = ('E1', n)
+        if key not in self.cache:
+            if (self.method == 'exact' or
+                    (self.method == 'auto' and n_splits(n) <= self.max_exact)):
+                self.cache[key] = exact_e1(n)
+            else:
+                self.cache[key] = self.sample('E1', (n,))
+        return self.cache[key]
+
+    def f_null(self, N_1, N_2):
+        """NullDistribution of the alternating runs of walks with N_1
+           heads and N_2 tails."""
+        N_1, N_2 = int(N_1), int(N_2)
+        key = ('F', N_1, N_2)
+        if key not in self.cache:
+            if self.method == 'monte_carlo':
+                self.cache[key] = self.sample('F', (N_1, N_2))
+            else:
+                self.cache[key] = exact_f(N_1, N_2)
+        return self.cache[key]
+
+    def e1_pvalue(self, counts):
+        """P-value of Test E1 (more uneven type counts than expected) for
+           counts of fusion types (as from kc_tests.fusion_type_counts),
+           or for each row of a 2-D array of counts."""
+        counts = np.asarray(counts, dtype = np.int64)
+        rows = np.atleast_2d(counts)
+        n = rows.sum(axis = 1)
+        statistic = e1_statistic(rows)
+        pvalues = np.empty(len(rows))
+        for total in np.unique(n):
+            same = n == total
+            pvalues[same] = self.e1_null(total).pvalue(statistic[same])
+        return float(pvalues[0]) if counts.ndim == 1 else pvalues
+
+    def f_pvalue(self, alternating_runs, N_1, N_2, alternative = 'less'):
+        """P-value of Test F for the number of alternating runs of a walk
+           with N_1 heads and N_2 tails: of so few alternating runs
+           ('less', as kc_tests.modified_wald_wolfowitz), or of so many
+           ('greater'). Also works on arrays, element by element."""
+        runs, N_1, N_2 = np.broadcast_arrays(alternating_runs, N_1, N_2)
+        pvalues = np.empty(runs.shape)
+        pairs = np.stack([N_1.ravel(), N_2.ravel()], axis = 1)
+        for heads, tails in np.unique(pairs, axis = 0) if len(pairs) else []:
+            same = (N_1 == heads) & (N_2 == tails)
+            pvalues[same] = self.f_null(heads, tails).pvalue(runs[same],
+                                                             alternative)
+        return float(pvalues) if pvalues.ndim == 0 else pvalues
+
+    def clear(self):
+        self.cache.clear()
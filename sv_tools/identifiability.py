@@ -1,18 +1,23 @@
 import simulator as sim
+import segments
 import itertools as it
+import collections
+import operator
+import os
+import shutil
+import tempfile
+import cPickle as pickle
 import numpy     as np
-import networkx  as nx
-import re
 
 # Helper functions
 
 def parse_string(string):
-    return re.findall(".\'?", string)
+    return segments.parse_tokens(string)
 
 def flip(token):
-    if len(token) == 2:
-        return token[0]
-    elif len(token) == 1:
+    if token.endswith("'"):
+        return token[:-1]
+    else:
         return token + "'"
 
 def reverse_string(string):
@@ -26,9 +31,14 @@ class ChromString(object):
         and eliminate redundancy. Currently only using it within 
         functions.
         
-        Create using a string like "AB'CE". """
+        Create using a string like "AB'CE", or "[p1][p3]'[p2]" for
+        segments with longer names. Those need the reference of the
+        unrearranged chromosome (a segments.Reference) for their
+        fusions and CN; it is kept with the string, and passed on to
+        the strings made from it, but plays no part in equality. """
     
-    def __init__(self, raw_string):
+    def __init__(self, raw_string, reference = None):
+        self.reference = reference
         if raw_string.count("'") < \
            reverse_string(raw_string).count("'"):
             self.string = raw_string
@@ -41,8 +51,8 @@ class ChromString(object):
             self.string = reverse_string(raw_string)
 
     @staticmethod
-    def from_tokens(tokens):
-        return ChromString("".join(tokens))
+    def from_tokens(tokens, reference = None):
+        return ChromString("".join(tokens), reference)
     
     # Main methods -- all non-mutating I hope.
     
@@ -63,7 +73,7 @@ class ChromString(object):
     
         new_tokens = [flip_if(i, t) for i, t in enumerate(tokens)]
         
-        return ChromString("".join(new_tokens))
+        return ChromString("".join(new_tokens), self.reference)
         
     def deleted_indices(self, indices):
         tokens = self.tokens()
@@ -71,10 +81,44 @@ class ChromString(object):
         new_tokens = [t for i, t in enumerate(tokens)
                       if not (i in indices)]
                       
-        return ChromString.from_tokens(new_tokens)
+        return ChromString.from_tokens(new_tokens, self.reference)
         
     def plot_sv_diagram(self, outfile = None):
-        sim.simulate_sv_diagram(self.string, outfile = None)
+        sim.simulate_sv_diagram(self.string, outfile = None,
+                                reference = self.reference)
+
+    def chrom_code(self):
+        """The ChromCode of the chromosome, with segments numbered in
+           the order of its reference (by default, segments.Reference.
+           default of its segments), so that adjacent segments have
+           consecutive numbers. Single letters in alphabetical order
+           are numbered by ord, as in clash tables."""
+        names = sorted(set(map(segments.token_name, self.tokens())),
+                       key = segments.natural_key)
+        reference = self.reference
+        if reference == None:
+            reference = segments.Reference.default(names)
+        ordered = reference.names
+        if (all(len(name) == 1 for name in ordered) and
+                all(ord(b) == ord(a) + 1
+                    for a, b in zip(ordered, ordered[1:]))):
+            return ChromCode.from_string(self.string)
+        return ChromCode.from_string(self.string, ordered)
+
+    def clash_class(self, table = None):
+        """(class id, class size) of the chromosome's clash class: the
+           rearrangements of its segments with the same sv_diagram_data.
+           Read from table (a clash_table.ClashTable) if it covers the
+           chromosome; otherwise computed, with a class id of None."""
+        code = self.chrom_code()
+        if table != None and code.alphabet == None:
+            found = table.lookup(code)
+            if found != None:
+                return found
+        return None, clash_class_size(code)
+
+    def is_identifiable(self, table = None):
+        return self.clash_class(table)[1] == 1
     
     def __repr__(self):
         return self.string
@@ -85,6 +129,121 @@ class ChromString(object):
     def __hash__(self):
         return hash(self.__repr__())
 
+# Signed permutations
+
+def reverse_complement(values):
+    return tuple([-v for v in reversed(values)])
+
+def orientation_key(values):
+    """Sort key for the two ways of writing a chromosome: fewer inverted
+       segments first, as ChromString prefers, then the smaller tuple."""
+    return (sum(1 for v in values if v < 0), values)
+
+def canonical(values):
+    """Of a tuple of signed segment numbers and its reverse complement,
+       the one first by orientation_key."""
+    values = tuple(values)
+    return min(values, reverse_complement(values), key = orientation_key)
+
+def number_of_token(token, alphabet = None):
+    name = segments.token_name(token)
+    if alphabet != None:
+        number = alphabet.index(name) + 1
+    elif len(name) == 1:
+        number = ord(name)
+    else:
+        raise ValueError("An alphabet is needed for segment %s" % name)
+    if segments.token_inverted(token):
+        return -number
+    else:
+        return number
+
+def token_of_number(number, alphabet = None):
+    if alphabet != None:
+        name = alphabet[abs(number) - 1]
+    else:
+        name = chr(abs(number))
+    return segments.name_token(name, number < 0)
+
+class ChromCode(object):
+    """ A faster stand-in for ChromString: a chromosome as a tuple of
+        signed segment numbers, negative when inverted. Letters are
+        numbered by ord(); segments with longer names by their position
+        (from 1) in an alphabet, a list of names. Canonical form is
+        whichever of the tuple and its reverse complement has fewer
+        inverted segments (see canonical); ties, which ChromString
+        breaks on the string, are broken on the tuple, so the two can
+        pick different representatives of the same class. Like
+        sv_data.Fusion, it is immutable, and hashed once.
+
+        Create using ChromCode.from_string("AB'CE"). """
+
+    __slots__ = ['values', 'alphabet', '_hash']
+
+    def __init__(self, values, alphabet = None):
+        self.values = canonical(values)
+        self.alphabet = alphabet
+        self._hash = hash(self.values)
+
+    @staticmethod
+    def from_canonical(values, alphabet = None):
+        """A ChromCode from a tuple already in canonical form."""
+        code = ChromCode.__new__(ChromCode)
+        code.values = values
+        code.alphabet = alphabet
+        code._hash = hash(values)
+        return code
+
+    @staticmethod
+    def from_string(string, alphabet = None):
+        return ChromCode([number_of_token(t, alphabet)
+                          for t in parse_string(string)], alphabet)
+
+    def from_tokens(self, tokens):
+        return ChromCode(tokens, self.alphabet)
+
+    @property
+    def string(self):
+        return "".join([token_of_number(v, self.alphabet)
+                        for v in self.values])
+
+    def chrom_string(self):
+        return ChromString(self.string)
+
+    def tokens(self):
+        return self.values
+
+    def flipped_indices(self, indices):
+        return self.from_tokens([-v if i in indices else v
+                                 for i, v in enumerate(self.values)])
+
+    def deleted_indices(self, indices):
+        return self.from_tokens([v for i, v in enumerate(self.values)
+                                 if not (i in indices)])
+
+    def plot_sv_diagram(self, outfile = None):
+        self.chrom_string().plot_sv_diagram(outfile)
+
+    def __repr__(self):
+        return self.string
+
+    def __len__(self):
+        return len(self.values)
+
+    def __eq__(self, other):
+        if not isinstance(other, ChromCode):
+            return NotImplemented
+        return self.values == other.values
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return self._hash
+
+    def __reduce__(self):
+        return (ChromCode, (self.values, self.alphabet))
+
 # Helper function(s)
 
 def powerset(iterable):
@@ -97,9 +256,13 @@ def powerset(iterable):
 # --- Permutations, inversions, deletions, and rearrangements
 
 def all_permutations(chrom_string):   
-    "Returns all permutations of the characters of a string."
+    """Returns all permutations of the characters of a string (of the
+       same class, ChromString or ChromCode, as chrom_string)."""
     permuted_tokens = it.permutations(chrom_string.tokens())
-    return set(map(ChromString.from_tokens, permuted_tokens))
+    if isinstance(chrom_string, ChromString):
+        return set(ChromString.from_tokens(t, chrom_string.reference)
+                   for t in permuted_tokens)
+    return set(map(chrom_string.from_tokens, permuted_tokens))
 
 def all_inversions(chrom_strings):
     out_strings = (s.flipped_indices(indices)
@@ -116,28 +279,390 @@ def all_deletions(chrom_strings):
     return set(out_strings)
     
 def all_rearrangements(chrom_string):
-    # This is highly inefficient: need to avoid redundancy.
-    return set(
-           all_inversions(all_deletions(all_permutations(chrom_string)))
-           )
+    """All rearrangements of a ChromString, each with the reference of
+       chrom_string (by default, segments.Reference.default of its
+       segments)."""
+    names = sorted(set(map(segments.token_name, chrom_string.tokens())),
+                   key = segments.natural_key)
+    reference = chrom_string.reference
+    if reference == None:
+        reference = segments.Reference.default(names)
+    code = ChromCode.from_string(chrom_string.string, names)
+    return set(ChromString(c.string, reference)
+               for c in iter_rearrangements(code))
+
+# --- Streaming enumeration, without redundancy
+
+def sub_multisets(values, k):
+    """Distinct sub-multisets of size k of a list of values, as sorted
+       tuples, one at a time."""
+    distinct = sorted(set(values))
+    counts = [values.count(v) for v in distinct]
+    for taken in it.product(*[range(c + 1) for c in counts]):
+        if sum(taken) == k:
+            yield tuple(v for v, t in zip(distinct, taken)
+                          for _ in range(t))
+
+def unique_permutations(items):
+    """Distinct orderings of items, in lexicographic order, one at a
+       time (by repeatedly finding the next permutation)."""
+    order = sorted(items)
+    n = len(order)
+    while True:
+        yield tuple(order)
+        i = n - 2
+        while i >= 0 and order[i] >= order[i + 1]:
+            i -= 1
+        if i < 0:
+            return
+        j = n - 1
+        while order[j] <= order[i]:
+            j -= 1
+        order[i], order[j] = order[j], order[i]
+        order[i + 1:] = reversed(order[i + 1:])
+
+def iter_rearrangements(chrom_code):
+    """Yields each rearrangement of a ChromCode (the classes of
+       all_rearrangements) exactly once, in canonical form, without
+       keeping those already seen: for each sub-multiset of its
+       segments, each distinct order, then each choice of orientations.
+       A rearrangement and its reverse complement share a subset, and
+       have reversed orders, so only orders no greater than their
+       reverse are used; for orders equal to their reverse, only
+       orientations no greater than their reverse complement."""
+    values = [abs(v) for v in chrom_code.values]
+    alphabet = chrom_code.alphabet
+    yield ChromCode.from_canonical((), alphabet)
+    for k in range(1, len(values) + 1):
+        for subset in sub_multisets(values, k):
+            for order in unique_permutations(subset):
+                reverse_order = order[::-1]
+                if reverse_order < order:
+                    continue
+                palindromic = reverse_order == order
+                for signs in it.product((1, -1), repeat = k):
+                    signed = tuple(map(operator.mul, order, signs))
+                    reverse = reverse_complement(signed)
+                    if palindromic and reverse < signed:
+                        continue
+                    # As canonical(), counting inverted segments from
+                    # the signs.
+                    twice_inverted = 2 * signs.count(-1)
+                    if (twice_inverted < k or
+                            (twice_inverted == k and signed <= reverse)):
+                        yield ChromCode.from_canonical(signed, alphabet)
+                    else:
+                        yield ChromCode.from_canonical(reverse, alphabet)
+
+def canonical_rows(rows):
+    """canonical() for each row of an array of signed segment numbers:
+       the row, or its reverse complement if that has fewer inverted
+       segments, or as many and is lexicographically smaller."""
+    reverse = -rows[:, ::-1]
+    inverted = (rows < 0).sum(axis = 1)
+    reverse_inverted = rows.shape[1] - inverted
+    differ = rows != reverse
+    first = differ.argmax(axis = 1)
+    index = np.arange(len(rows))
+    smaller = rows[index, first] <= reverse[index, first]
+    keep = ((inverted < reverse_inverted) |
+            ((inverted == reverse_inverted) & smaller))
+    return np.where(keep[:, None], rows, reverse)
+
+def unique_rows(rows):
+    """The distinct rows of an array of signed segment numbers, sorted
+       as packed integers when they fit in 63 bits."""
+    base = 2 * np.abs(rows).max() + 1
+    if rows.shape[1] * np.log2(base) >= 63:
+        return np.unique(rows, axis = 0)
+    packed = np.zeros(len(rows), dtype = np.int64)
+    for column in rows.T:
+        packed = packed * base + (column + base // 2)
+    _, first = np.unique(packed, return_index = True)
+    return rows[first]
+
+def all_rearrangement_codes(chrom_code):
+    """all_rearrangements of a ChromCode, computed with arrays: every
+       ordering of every subset of its segments, with every choice of
+       orientations, reduced to canonical form."""
+    values = sorted(abs(v) for v in chrom_code.values)
+    found = set([()])
+    for k in range(1, len(values) + 1):
+        orders = set(order for subset in set(it.combinations(values, k))
+                           for order in it.permutations(subset))
+        orders = np.array(sorted(orders), dtype = np.int64)
+        signs = np.array(list(it.product((1, -1), repeat = k)),
+                         dtype = np.int64)
+        signed = (orders[:, None, :] * signs[None, :, :]).reshape(-1, k)
+        unique = unique_rows(canonical_rows(signed))
+        found.update(map(tuple, unique.tolist()))
+    return set(ChromCode.from_canonical(v, chrom_code.alphabet)
+               for v in found)
     
 # --- Identifiability
 
-def fusion_set(chrom_string):
-    return set(sim.get_fusions(sim.letters_to_positions(chrom_string.string)))
+# Fusions and CN are found on the reference of the unrearranged
+# chromosome: the one given, or else the ChromString's own (as set by
+# all_rearrangements). Single letters can do without one, as they are laid
+# out by ord (see segments.Reference.for_letters), but longer names
+# cannot: a reference made from the names in one rearrangement would
+# miss the segments it deletes, and shift from one rearrangement to the
+# next.
+
+def diagram_reference(chrom_string, reference = None):
+    if reference == None:
+        reference = chrom_string.reference
+    if reference == None:
+        names = map(segments.token_name, chrom_string.tokens())
+        if not all(len(name) == 1 and name.isalpha() for name in names):
+            raise ValueError("A reference is needed for %s" %
+                             chrom_string.string)
+    return reference
+
+def fusion_set(chrom_string, reference = None):
+    chromosome = segments.SegmentChromosome.parse(
+                     chrom_string.string,
+                     diagram_reference(chrom_string, reference))
+    return set(chromosome.fusions(scale = 1e6))
     
-def sv_diagram_data(chrom_string):
+def sv_diagram_data(chrom_string, reference = None):
     if len(chrom_string.string) > 0:
-        x, cn = sim.get_x_cn(sim.letters_to_positions(chrom_string.string))
-        letters = set([l for l in chrom_string.string if l.isalnum()])
-        return letters, cn, fusion_set(chrom_string)
+        chromosome = segments.SegmentChromosome.parse(
+                         chrom_string.string,
+                         diagram_reference(chrom_string, reference))
+        # CN in order of position, as in the diagram, so that it does
+        # not depend on which way round the chromosome is written.
+        x, _ = chromosome.x_cn()
+        cn = chromosome.cn_at(np.unique(x))
+        letters = set(map(segments.token_name,
+                          parse_string(chrom_string.string)))
+        return letters, cn.tolist(), set(chromosome.fusions(scale = 1e6))
     else:
         return None
 
+def signature(value):
+    """A hashable form of a mapping_function output, equal for equal
+       outputs: sets become frozensets, and lists, tuples and arrays
+       become tuples."""
+    if isinstance(value, (set, frozenset)):
+        return frozenset(map(signature, value))
+    elif isinstance(value, (list, tuple)):
+        return tuple(map(signature, value))
+    elif isinstance(value, np.ndarray):
+        return tuple(value.tolist())
+    elif isinstance(value, dict):
+        return frozenset((k, signature(v)) for k, v in value.items())
+    else:
+        return value
+
 def find_clashes(chrom_strings, mapping_function):
-    d = {s:mapping_function(s) for s in chrom_strings}
-    clash_pairs = ((x,y) for x in d for y in d 
-                         if (x != y and d[x] == d[y]))
-    clash_components = nx.connected_components(nx.Graph(clash_pairs))
-    return clash_components
-    
\ No newline at end of file
+    """Groups of (two or more) chrom_strings with equal
+       mapping_function outputs, found by grouping on their signature."""
+    buckets = collections.defaultdict(list)
+    for s in chrom_strings:
+        buckets[signature(mapping_function(s))].append(s)
+    return (set(bucket) for bucket in buckets.values() if len(bucket) > 1)
+
+def find_clashes_streaming(chrom_strings, mapping_function,
+                           max_in_memory = 1000000, n_partitions = 64,
+                           directory = None):
+    """As find_clashes, for a stream of chrom_strings (e.g. from
+       iter_rearrangements) too large to group in memory. Once more than
+       max_in_memory have been read, buckets are spilled to n_partitions
+       files (in a temporary directory, within directory if given),
+       chosen by signature hash, so that each partition can then be
+       grouped in memory in turn."""
+    buckets = collections.defaultdict(list)
+    in_memory = 0
+    spill_dir = None
+    try:
+        for s in chrom_strings:
+            buckets[signature(mapping_function(s))].append(s)
+            in_memory += 1
+            if in_memory > max_in_memory:
+                if spill_dir == None:
+                    spill_dir = tempfile.mkdtemp(prefix = "clashes",
+                                                 dir = directory)
+                spill_buckets(buckets, spill_dir, n_partitions)
+                buckets = collections.defaultdict(list)
+                in_memory = 0
+
+        if spill_dir == None:
+            for bucket in buckets.values():
+                if len(bucket) > 1:
+                    yield set(bucket)
+            return
+
+        spill_buckets(buckets, spill_dir, n_partitions)
+        buckets = None
+        for partition in range(n_partitions):
+            merged = collections.defaultdict(list)
+            for key, bucket in read_partition(spill_dir, partition):
+                merged[key].extend(bucket)
+            for bucket in merged.values():
+                if len(bucket) > 1:
+                    yield set(bucket)
+    finally:
+        if spill_dir != None:
+            shutil.rmtree(spill_dir, ignore_errors = True)
+
+def partition_file(spill_dir, partition):
+    return os.path.join(spill_dir, "partition_%d.pickle" % partition)
+
+def spill_buckets(buckets, spill_dir, n_partitions):
+    """Appends each (signature, bucket) pair to its partition's file."""
+    by_partition = collections.defaultdict(list)
+    for key, bucket in buckets.items():
+        by_partition[hash(key) % n_partitions].append((key, bucket))
+    for partition, items in by_partition.items():
+        with open(partition_file(spill_dir, partition), 'ab') as f:
+            pickle.dump(items, f, pickle.HIGHEST_PROTOCOL)
+
+def read_partition(spill_dir, partition):
+    filename = partition_file(spill_dir, partition)
+    if not os.path.exists(filename):
+        return
+    with open(filename, 'rb') as f:
+        while True:
+            try:
+                items = pickle.load(f)
+            except EOFError:
+                return
+            for item in items:
+                yield item
+
+# --- Adjacency signatures
+#
+# The data of sv_diagram_data only depend on how many times each segment
+# occurs (the CN) and on which segment ends are joined (the fusions), so
+# they can be read off the signed segment numbers of a ChromCode, in
+# O(k). The two ends of segment s are numbered 2 * s (its start) and
+# 2 * s + 1 (its end); with segments numbered in reference order, as
+# letters are, these numbers follow position. Segments numbered s and
+# s + 1 are taken to be neighbours in the reference.
+
+def junction(a, b):
+    """The fusion made by segment a followed by segment b (signed
+       numbers), as a (lower, higher) pair of end numbers, or None if
+       a and b rejoin the reference."""
+    if b == a + 1:
+        return None
+    left = 2 * abs(a) + (a > 0)
+    right = 2 * abs(b) + (b < 0)
+    if left <= right:
+        return (left, right)
+    else:
+        return (right, left)
+
+def adjacency_signature(chrom_code):
+    """Signature of a ChromCode (or a ChromString) with the same clashes
+       as sv_diagram_data: (segment counts, fusions)."""
+    if isinstance(chrom_code, ChromCode):
+        values = chrom_code.values
+    else:
+        values = chrom_code.chrom_code().values
+    counts = collections.Counter(abs(v) for v in values)
+    fusions = (junction(a, b) for a, b in zip(values, values[1:]))
+    return (frozenset(counts.items()),
+            frozenset(f for f in fusions if f != None))
+
+class AdjacencySignature(object):
+    """ adjacency_signature of a changing chromosome. Flipping or
+        deleting one segment only touches the junctions either side of
+        it, so the counts of segments and of fusions are updated in
+        O(1) rather than recomputed. """
+
+    def __init__(self, values):
+        self.values = list(values)
+        self.counts = collections.Counter(abs(v) for v in self.values)
+        self.fusions = collections.Counter()
+        for a, b in zip(self.values, self.values[1:]):
+            self.add_junction(a, b, 1)
+
+    def add_junction(self, a, b, n):
+        key = junction(a, b)
+        if key != None:
+            self.fusions[key] += n
+            if self.fusions[key] == 0:
+                del self.fusions[key]
+
+    def update_neighbours(self, i, n):
+        """Adds (n = 1) or removes (n = -1) the junctions of segment i."""
+        values = self.values
+        if i > 0:
+            self.add_junction(values[i - 1], values[i], n)
+        if i < len(values) - 1:
+            self.add_junction(values[i], values[i + 1], n)
+
+    def flip(self, i):
+        self.update_neighbours(i, -1)
+        self.values[i] = -self.values[i]
+        self.update_neighbours(i, 1)
+
+    def delete(self, i):
+        values = self.values
+        self.update_neighbours(i, -1)
+        if 0 < i < len(values) - 1:
+            self.add_junction(values[i - 1], values[i + 1], 1)
+        segment = abs(values.pop(i))
+        self.counts[segment] -= 1
+        if self.counts[segment] == 0:
+            del self.counts[segment]
+
+    def signature(self):
+        return (frozenset(self.counts.items()), frozenset(self.fusions))
+
+def iter_signatures(chrom_code):
+    """Yields (rearrangement, adjacency signature) pairs for the
+       rearrangements of iter_rearrangements."""
+    values = [abs(v) for v in chrom_code.values]
+    for k in range(len(values) + 1):
+        for subset in sub_multisets(values, k):
+            for pair in subset_signatures(subset, chrom_code.alphabet):
+                yield pair
+
+def subset_signatures(subset, alphabet = None, prefix = ()):
+    """iter_signatures for the rearrangements made of exactly the
+       segments of subset (a sorted tuple of segment numbers), and, if
+       a prefix is given, only for orders of the segments starting with
+       it. Orientations of each order are visited in Gray code order, so
+       that each step flips one segment and updates the signature
+       incrementally."""
+    k = len(subset)
+    rest = list(subset)
+    for v in prefix:
+        rest.remove(v)
+    for tail in unique_permutations(rest):
+        order = tuple(prefix) + tail
+        reverse_order = order[::-1]
+        if reverse_order < order:
+            continue
+        palindromic = reverse_order == order
+        state = AdjacencySignature(order)
+        for step in range(2 ** k):
+            if step > 0:
+                # The bit that changes in the Gray code.
+                state.flip((step & -step).bit_length() - 1)
+            signed = tuple(state.values)
+            reverse = reverse_complement(signed)
+            if palindromic and reverse < signed:
+                continue
+            first = min(signed, reverse, key = orientation_key)
+            yield (ChromCode.from_canonical(first, alphabet),
+                   state.signature())
+
+def rearrangement_clashes(chrom_code):
+    """find_clashes(iter_rearrangements(chrom_code), sv_diagram_data),
+       from adjacency signatures."""
+    buckets = collections.defaultdict(list)
+    for code, key in iter_signatures(chrom_code):
+        buckets[key].append(code)
+    return (set(bucket) for bucket in buckets.values() if len(bucket) > 1)
+
+def clash_class_size(chrom_code):
+    """Number of rearrangements of the segments of chrom_code (including
+       itself) with the same adjacency signature."""
+    subset = tuple(sorted(abs(v) for v in chrom_code.values))
+    target = adjacency_signature(chrom_code)
+    return sum(1 for _, key in subset_signatures(subset, chrom_code.alphabet)
+               if key == target)
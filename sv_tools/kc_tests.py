@@ -1,13 +1,28 @@
+from collections import namedtuple
+
 import pandas as pd
 import numpy as np
 
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-import scipy.stats as stats
+# matplotlib and scipy are slow to import and are only needed for
+# plotting and p-values, so they are imported when first used.
+
+fonts_set = False
+
+def pyplot():
+    """matplotlib.pyplot, with the fonts used here."""
+    global fonts_set
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt
+    if not fonts_set:
+        # Use Helvetica as the default font family
+        mpl.rcParams['font.family'] = 'Helvetica2'
+        mpl.rcParams['font.size'] = 12
+        fonts_set = True
+    return plt
 
-# Use Helvetica as the default font family
-mpl.rcParams['font.family'] = 'Helvetica2'
-mpl.rcParams['font.size'] = 12
+def scipy_stats():
+    import scipy.stats
+    return scipy.stats
 
 fusion_type_color = {"D":  "#AC4142",
                      "TD": "#6A9FB5",
@@ -27,9 +42,12 @@ Test F - Ability to walk the derivative chromosome.
 ## Test E1 - randomness of fragment joins. ##
 
 def fusion_type_counts(fusions):
-    """Takes a list of fusions, returns a pd.Series
-       of counts of fusion types."""
-    fusion_types = pd.Series(map(lambda x: x.type(), fusions))
+    """Takes a list of fusions (or an sv_data.FusionTable),
+       returns a pd.Series of counts of fusion types."""
+    if hasattr(fusions, 'types'):
+        fusion_types = fusions.types()
+    else:
+        fusion_types = pd.Series(map(lambda x: x.type(), fusions))
     counts = fusion_types.value_counts(sort = False)
     # Put fusion types in the right order..
     ordered = counts[['D','TD','HH','TT']]
@@ -38,6 +56,7 @@ def fusion_type_counts(fusions):
 def plot_counts(counts, outfile, xlabel = None):
     """From a pd.Series of counts of fusion types,
        plots a histogram."""
+    plt = pyplot()
     fig, axes = plt.subplots()
     fig.set_figwidth(3), fig.set_figheight(3)
 
@@ -82,7 +101,7 @@ def chisq_test(counts):
     """From a pd.Series of counts of fusion types,
        conducts a chi-squared test."""
     count_array = np.array(counts)
-    chisq, p = stats.chisquare(count_array)
+    chisq, p = scipy_stats().chisquare(count_array)
     return chisq, p
 
 def test_E1(fusions, outfile, label = None):
@@ -100,31 +119,20 @@ def test_E1(fusions, outfile, label = None):
 ## Test F - Ability to "walk" the derivative chromosome. ##
 
 def acc_alternating_runs(segments, walk): # Names could be improved here.
-    """Recursive function that takes an empty list and a H/T
-       string and returns a list of alternating segments."""
+    """Takes a list of alternating segments and a H/T string, and
+       returns the list with the alternating segments of the string
+       added (the first joining the last segment, if they alternate).
+       A new segment starts wherever a letter repeats."""
     if len(walk) == 0:
         return segments
+    cuts = [i for i in xrange(1, len(walk)) if walk[i] == walk[i - 1]]
+    starts = [0] + cuts
+    ends = cuts + [len(walk)]
+    runs = [walk[start:end] for start, end in zip(starts, ends)]
+    if segments != [] and segments[-1][-1] != walk[0]:
+        return segments[:-1] + [segments[-1] + runs[0]] + runs[1:]
     else:
-        next_letter = walk[0]
-
-    def conjoin(segments, next_letter):
-        if segments == []:
-            return [next_letter]
-        else:
-            last_segment = segments[-1]
-            last_letter = last_segment[-1]
-            if last_letter == next_letter:
-                return segments + [next_letter]
-            elif last_letter != next_letter:
-                return segments[:-1] + [last_segment + next_letter]
-
-    if len(walk) == 1:
-        return conjoin(segments, next_letter)
-    else:
-        tail = walk[1:]
-        return acc_alternating_runs(
-                    conjoin(segments, next_letter),
-                    tail)
+        return segments + runs
 
 def alternating_runs(walk):
     return acc_alternating_runs([], walk)
@@ -133,27 +141,39 @@ def modified_wald_wolfowitz(alternating_runs, N_1, N_2):
     """Returns the mean and variance of the approximate sampling
        distribution of the number of alternating runs in a sequence with
        N_1 heads and N_2 tails, as well as a one-sided p-value for
-       alternating_runs. See ww_test.md for details."""
+       alternating_runs. See ww_test.md for details. Also works on
+       arrays, element by element."""
 
+    # In floating point: integer division would round the mean and
+    # variance down, shifting the p-values of small walks.
+    N_1 = np.asarray(N_1, dtype = float)
+    N_2 = np.asarray(N_2, dtype = float)
     N = N_1 + N_2
-    mean_runs = 1 + (2 * N_1 * N_2 / N)
-    var_runs = 2 * N_1 * N_2 * (2 * N_1 * N_2 - N) / (N**2 * (N - 1))
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        mean_runs = 1 + (2 * N_1 * N_2 / N)
+        var_runs = 2 * N_1 * N_2 * (2 * N_1 * N_2 - N) / (N**2 * (N - 1))
 
-    # If there are R
-    mean_alternating = N - mean_runs + 1
-    var_alternating = var_runs
+        # If there are R
+        mean_alternating = N - mean_runs + 1
+        var_alternating = var_runs
 
-    dist = stats.norm(loc = mean_alternating,
-                      scale = np.sqrt(var_alternating))
-    pvalue = dist.cdf(alternating_runs)
+        pvalue = scipy_stats().norm.cdf(alternating_runs,
+                                        loc = mean_alternating,
+                                        scale = np.sqrt(var_alternating))
 
+    if np.ndim(pvalue) == 0:
+        return float(mean_alternating), float(var_alternating), float(pvalue)
     return mean_alternating, var_alternating, pvalue
 
-def F_walk(walk):
-    """Breaks-up a walk, prints it (and its broken-up counterpart), and
-       conducts a modified Wolfowitz-Wald test."""
-    head_prop = (walk.count("H") / float(len(walk)))
+FWalkResult = namedtuple('FWalkResult',
+                         ['walk', 'runs', 'heads', 'tails',
+                          'alternating_runs', 'average_run_length',
+                          'mean', 'var', 'pvalue'])
 
+def F_walk(walk, verbose = True):
+    """Breaks-up a walk, conducts a modified Wolfowitz-Wald test, and
+       returns an FWalkResult. If verbose, prints the walk (and its
+       broken-up counterpart) and the test."""
     alt_runs = alternating_runs(walk)
     N_1 = walk.count("H")
     N_2 = walk.count("T")
@@ -162,10 +182,73 @@ def F_walk(walk):
 
     mean, var, pvalue = modified_wald_wolfowitz(len(alt_runs), N_1, N_2)
 
-    print walk
-    print "|".join([r for r in alt_runs])
-    print "heads: %s; tails: %s" % (N_1, N_2)
-    print ("alternating runs: %s; average run length: %.2f"
-            % (len(alt_runs), average_run_length))
-    print "expected alternating runs: ~ %s; sd: %s" % (mean, np.sqrt(var))
-    print "p-value: %.4g\n" % pvalue
+    if verbose:
+        print walk
+        print "|".join([r for r in alt_runs])
+        print "heads: %s; tails: %s" % (N_1, N_2)
+        print ("alternating runs: %s; average run length: %.2f"
+                % (len(alt_runs), average_run_length))
+        print "expected alternating runs: ~ %s; sd: %s" % (mean, np.sqrt(var))
+        print "p-value: %.4g\n" % pvalue
+
+    return FWalkResult(walk, alt_runs, N_1, N_2, len(alt_runs),
+                       average_run_length, mean, var, pvalue)
+
+## Test F for many walks at once ##
+
+def walk_array(walks):
+    """Walks as one boolean array (True for H) and the offsets of each
+       walk in it (walk i is at offsets[i]:offsets[i + 1]). walks is a
+       list of H/T strings, or a 2-D array with a walk per row: of
+       booleans, or of 'H' and 'T' characters, with any other character
+       as padding at the end of a row."""
+    if isinstance(walks, np.ndarray) and walks.ndim == 2:
+        if walks.dtype == bool:
+            valid = np.ones(walks.shape, dtype = bool)
+            is_head = walks
+        else:
+            letters = walks.astype(str)
+            valid = (letters == "H") | (letters == "T")
+            is_head = letters == "H"
+        lengths = valid.sum(axis = 1)
+        is_head = is_head[valid]
+    else:
+        lengths = np.array([len(w) for w in walks], dtype = np.int64)
+        letters = np.frombuffer("".join(walks).encode('ascii'),
+                                dtype = np.uint8)
+        is_head = letters == ord("H")
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    return is_head, offsets
+
+def alternating_run_counts(walks):
+    """Numbers of alternating runs (len(alternating_runs(walk))),
+       heads and tails of each of many walks (see walk_array), as
+       arrays."""
+    is_head, offsets = walk_array(walks)
+    n_walks = len(offsets) - 1
+    lengths = np.diff(offsets)
+    walk_ids = np.repeat(np.arange(n_walks), lengths)
+
+    repeats = (is_head[1:] == is_head[:-1]) & (walk_ids[1:] == walk_ids[:-1])
+    n_repeats = np.bincount(walk_ids[1:][repeats], minlength = n_walks)
+    runs = np.where(lengths > 0, n_repeats + 1, 0)
+    heads = np.bincount(walk_ids[is_head], minlength = n_walks)
+    return runs, heads, lengths - heads
+
+def F_walks(walks):
+    """F_walk for many walks at once, without printing: a pd.DataFrame
+       with a row per walk."""
+    runs, heads, tails = alternating_run_counts(walks)
+    mean, var, pvalue = modified_wald_wolfowitz(runs, heads, tails)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        average_run_length = (heads + tails) / runs.astype(float)
+    return pd.DataFrame({'heads': heads,
+                         'tails': tails,
+                         'alternating_runs': runs,
+                         'average_run_length': average_run_length,
+                         'mean': mean,
+                         'var': var,
+                         'pvalue': pvalue},
+                        columns = ['heads', 'tails', 'alternating_runs',
+                                   'average_run_length', 'mean', 'var',
+                                   'pvalue'])
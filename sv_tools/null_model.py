@@ -0,0 +1,271 @@
+"""
+Random rearrangements, as a null model for the tests in kc_tests.
+
+A chromosome of the given length is broken at n_breaks uniformly random
+positions. Each of the resulting segments is retained with probability
+retention, the retained segments are joined in a random order, and each
+is inverted with probability inversion. Many such chromosomes are made
+at once, as rows of arrays, and the fusions, copy number and Test E1/F
+statistics of every row are computed without leaving NumPy.
+
+Replicates are made in chunks, each with its own random stream seeded by
+(seed, chunk number), so results depend on the seed but not on the
+number of processes used.
+
+    null = null_model.null_distribution(10000, n_breaks = 40,
+                                        retention = .6, inversion = .5,
+                                        seed = 1, processes = 4)
+    observed = null_model.sample_statistics(fusions)
+    null_model.empirical_pvalue(null, observed, 'alternating_runs', 'less')
+"""
+
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+import sv_data
+import segments
+
+# Fusion types, by 2 * (bp1 is H) + (bp2 is H), in the order of
+# kc_tests.fusion_type_counts.
+fusion_types = ['D', 'TD', 'HH', 'TT']
+type_of_code = np.array([3, 0, 1, 2]) # TT, TH = D, HT = TD, HH
+
+statistic_columns = (['n_fusions'] + fusion_types +
+                     ['chisq', 'heads', 'tails', 'alternating_runs'])
+
+### Generating ###
+
+def check_breaks(n_breaks, length):
+    """There are only length - 1 places to break a chromosome."""
+    if not 0 <= n_breaks < length:
+        raise ValueError("n_breaks must be at least 0 and less than the "
+                         "length (%d)" % length)
+
+def random_rearrangements(rng, n_replicates, n_breaks, retention, inversion,
+                          length = 100000000):
+    """n_replicates random rearrangements, drawn with rng (a
+       np.random.RandomState), as a dict of arrays with a row per
+       replicate and a column per segment:
+
+       starts, ends: the reference segments, in reference order.
+       cn: copy number (0 or 1) of each reference segment.
+       order: ids of the retained segments, in the order they are
+              joined, padded with -1.
+       inverted: whether each segment in order is inverted.
+       n_retained: the number of retained segments of each row."""
+    check_breaks(n_breaks, length)
+    n_segments = n_breaks + 1
+    shape = (n_replicates, n_segments)
+
+    # Distinct break positions: repeats are drawn again until there are
+    # none left, which keeps every set of positions equally likely.
+    breaks = rng.randint(1, length, size = (n_replicates, n_breaks))
+    while True:
+        breaks.sort(axis = 1)
+        repeated = np.zeros(breaks.shape, dtype = bool)
+        repeated[:, 1:] = breaks[:, 1:] == breaks[:, :-1]
+        if not repeated.any():
+            break
+        breaks[repeated] = rng.randint(1, length, size = repeated.sum())
+    starts = np.column_stack([np.zeros(n_replicates, dtype = np.int64),
+                              breaks])
+    ends = np.column_stack([breaks,
+                            np.repeat(length, n_replicates)]).astype(np.int64)
+
+    retained = rng.random_sample(shape) < retention
+    # Sorting random keys shuffles the retained segments, which sort
+    # before the lost ones.
+    keys = np.where(retained, rng.random_sample(shape), 2.)
+    order = np.argsort(keys, axis = 1)
+    n_retained = retained.sum(axis = 1)
+    in_order = np.arange(n_segments) < n_retained[:, None]
+    order = np.where(in_order, order, -1)
+    inverted = (rng.random_sample(shape) < inversion) & in_order
+
+    return {'starts': starts,
+            'ends': ends,
+            'cn': retained.astype(np.int64),
+            'order': order,
+            'inverted': inverted,
+            'n_retained': n_retained}
+
+def fusion_arrays(rearrangements):
+    """Fusions of each row of rearrangements, as arrays with a column
+       per junction: pos1, is_head1, pos2, is_head2 (in Fusion's
+       order: bp1 has the lower position) and a mask of the junctions
+       that are fusions. A breakpoint is a head ('-' strand) when the
+       retained sequence is to its right."""
+    order = rearrangements['order']
+    inverted = rearrangements['inverted']
+    safe = np.maximum(order, 0)
+    starts = np.take_along_axis(rearrangements['starts'], safe, axis = 1)
+    ends = np.take_along_axis(rearrangements['ends'], safe, axis = 1)
+
+    left_inverted, right_inverted = inverted[:, :-1], inverted[:, 1:]
+    pos1 = np.where(left_inverted, starts[:, :-1], ends[:, :-1] - 1)
+    pos2 = np.where(right_inverted, ends[:, 1:] - 1, starts[:, 1:])
+    joined = order[:, 1:] >= 0
+    # As in segments.SegmentChromosome.fusion_data.
+    rejoined = ((left_inverted == right_inverted) &
+                (pos2 - pos1 == np.where(left_inverted, -1, 1)))
+
+    swap = pos2 < pos1
+    return {'pos1': np.where(swap, pos2, pos1),
+            'is_head1': np.where(swap, ~right_inverted, left_inverted),
+            'pos2': np.where(swap, pos1, pos2),
+            'is_head2': np.where(swap, left_inverted, ~right_inverted),
+            'mask': joined & ~rejoined}
+
+def fusion_table(rearrangements, row, chrom = ""):
+    """The fusions of one row, as an sv_data.FusionTable."""
+    fusions = fusion_arrays(rearrangements)
+    mask = fusions['mask'][row]
+    chroms = np.repeat(chrom, mask.sum())
+    strand = lambda is_head: np.where(is_head[row][mask], "-", "+")
+    return sv_data.FusionTable(pd.DataFrame(
+                {'chrom1': chroms,
+                 'pos1': fusions['pos1'][row][mask],
+                 'strand1': strand(fusions['is_head1']),
+                 'chrom2': chroms,
+                 'pos2': fusions['pos2'][row][mask],
+                 'strand2': strand(fusions['is_head2'])},
+                columns = sv_data.FusionTable.columns))
+
+def segment_chromosome(rearrangements, row):
+    """One row as a segments.SegmentChromosome, with segments named by
+       their reference order (s0, s1, ...)."""
+    starts = rearrangements['starts'][row]
+    reference = segments.Reference(["s%d" % i for i in range(len(starts))],
+                                   starts, rearrangements['ends'][row])
+    k = rearrangements['n_retained'][row]
+    return segments.SegmentChromosome(reference,
+                                      rearrangements['order'][row][:k],
+                                      rearrangements['inverted'][row][:k])
+
+### Statistics ###
+
+def chisq_statistics(counts):
+    """The statistic of kc_tests.chisq_test, for each row of counts."""
+    counts = np.asarray(counts, dtype = float)
+    expected = counts.mean(axis = 1, keepdims = True)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        return ((counts - expected) ** 2 / expected).sum(axis = 1)
+
+def walk_statistics(is_head, mask):
+    """Heads, tails and the number of alternating runs (see
+       kc_tests.alternating_runs) of each row of a walk: breakpoint
+       orientations in order of position, where mask marks the
+       breakpoints (at the start of each row) that exist."""
+    heads = (is_head & mask).sum(axis = 1)
+    tails = (~is_head & mask).sum(axis = 1)
+    repeats = ((is_head[:, 1:] == is_head[:, :-1]) &
+               mask[:, 1:]).sum(axis = 1)
+    runs = np.where(mask.any(axis = 1), repeats + 1, 0)
+    return heads, tails, runs
+
+def statistics(rearrangements):
+    """Test E1 and F statistics of each row of rearrangements, as a
+       data frame with statistic_columns."""
+    fusions = fusion_arrays(rearrangements)
+    mask = fusions['mask']
+    n_rows = mask.shape[0]
+
+    codes = 2 * fusions['is_head1'] + fusions['is_head2']
+    rows = np.repeat(np.arange(n_rows), mask.shape[1]).reshape(mask.shape)
+    counts = np.bincount((4 * rows + type_of_code[codes])[mask],
+                         minlength = 4 * n_rows).reshape(n_rows, 4)
+
+    # The walk: all breakpoints, sorted by position within each row.
+    # Ties keep the order of sv_data.FusionTable.breakpoint_data.
+    def interleave(first, second):
+        return np.stack([first, second], axis = 2).reshape(n_rows, -1)
+
+    pos = interleave(fusions['pos1'], fusions['pos2'])
+    is_head = interleave(fusions['is_head1'], fusions['is_head2'])
+    bp_mask = interleave(mask, mask)
+    by_pos = np.argsort(np.where(bp_mask, pos, np.iinfo(np.int64).max),
+                        axis = 1, kind = 'mergesort')
+    heads, tails, runs = walk_statistics(
+                            np.take_along_axis(is_head, by_pos, axis = 1),
+                            np.take_along_axis(bp_mask, by_pos, axis = 1))
+
+    data = pd.DataFrame(counts, columns = fusion_types)
+    data.insert(0, 'n_fusions', mask.sum(axis = 1))
+    data['chisq'] = chisq_statistics(counts)
+    data['heads'] = heads
+    data['tails'] = tails
+    data['alternating_runs'] = runs
+    return data[statistic_columns]
+
+def sample_statistics(fusions):
+    """The statistics of a sample's fusions (a list of Fusions or an
+       sv_data.FusionTable, usually of one chromosome), as a pd.Series
+       comparable with a row of null_distribution."""
+    table = sv_data.FusionTable.from_fusions(fusions)
+    types = table.types()
+    counts = np.array([[(types == t).sum() for t in fusion_types]])
+
+    breakpoints = table.breakpoint_data()
+    by_pos = np.lexsort((breakpoints['pos'].values,
+                         breakpoints['chrom'].values.astype(str)))
+    is_head = (breakpoints['strand'].values[by_pos] == "-")[None, :]
+    heads, tails, runs = walk_statistics(is_head,
+                                         np.ones_like(is_head, dtype = bool))
+
+    values = ([len(table)] + list(counts[0]) +
+              [chisq_statistics(counts)[0], heads[0], tails[0], runs[0]])
+    return pd.Series(values, index = statistic_columns)
+
+def empirical_pvalue(null, observed, column, alternative = 'greater'):
+    """P-value of observed[column] (e.g. from sample_statistics) under
+       the null distribution: the proportion of null rows at least as
+       large ('greater') or at most as large ('less'), counting the
+       observation itself."""
+    values = null[column].values
+    if alternative == 'greater':
+        extreme = (values >= observed[column]).sum()
+    elif alternative == 'less':
+        extreme = (values <= observed[column]).sum()
+    else:
+        raise ValueError("alternative must be 'greater' or 'less'")
+    return (extreme + 1) / float(len(values) + 1)
+
+### Null distributions ###
+
+def simulate_chunk(job):
+    """Statistics of one chunk of replicates, from its own random
+       stream."""
+    seed, chunk, n_replicates, parameters = job
+    rng = np.random.RandomState([seed, chunk])
+    return statistics(random_rearrangements(rng, n_replicates, **parameters))
+
+def null_distribution(n_replicates, n_breaks, retention = 1.,
+                      inversion = .5, length = 100000000, seed = 0,
+                      chunk_size = 1000, processes = 1):
+    """Test E1/F statistics of n_replicates random rearrangements, as a
+       data frame with a row per replicate. processes = 1 runs in this
+       process; None uses one process per CPU. The result depends only
+       on the seed and chunk_size."""
+    check_breaks(n_breaks, length)
+    parameters = {'n_breaks': n_breaks, 'retention': retention,
+                  'inversion': inversion, 'length': length}
+    sizes = [min(chunk_size, n_replicates - start)
+             for start in range(0, n_replicates, chunk_size)]
+    jobs = [(seed, chunk, size, parameters)
+            for chunk, size in enumerate(sizes)]
+
+    if processes == 1:
+        results = map(simulate_chunk, jobs)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(simulate_chunk, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    if len(results) == 0:
+        return pd.DataFrame(columns = statistic_columns)
+    return pd.concat(results, ignore_index = True)
@@ -0,0 +1,190 @@
+"""
+Reconstructing rearranged chromosomes from their fusions and copy number.
+
+identifiability works forwards, from rearrangements to their diagrams.
+This goes backwards: given the fusions seen in a sample and the copy
+number of each segment between breakpoints, it finds the segment orders
+that explain them, by a depth-first search that extends a walk one
+segment at a time. A walk may only continue into the next reference
+segment, or along an observed fusion, and only while the segment has
+copies left; it is abandoned as soon as fewer segments remain than
+observed fusions still unused. Each reconstruction is found once, in
+canonical form (see identifiability.ChromCode).
+
+Segments are numbered and fusions written as in
+identifiability.adjacency_signature, so that
+
+    reconstruction.reconstruct(*identifiability.adjacency_signature(code))
+
+gives the clash class of code. For sample data, sample_signature turns
+fusions and copy number (as from sv_data) into segments first:
+
+    reference, counts, fusions = reconstruction.sample_signature(
+                                     fusions, x, cn)
+    chromosomes = reconstruction.reconstruct(counts, fusions, limit = 10,
+                                             alphabet = reference.names)
+"""
+
+import itertools as it
+
+import numpy as np
+
+import identifiability as idf
+import segments
+
+### Search ###
+
+def entry_token(end):
+    """The signed segment a walk enters through a segment end."""
+    segment = end // 2
+    if end % 2 == 1:
+        return -segment
+    else:
+        return segment
+
+def exit_end(token):
+    """The segment end a walk leaves a signed segment through."""
+    return 2 * abs(token) + (token > 0)
+
+def successor_table(tokens, fusions):
+    """The tokens that may follow each token: the next reference
+       segment, in the same orientation, and the far side of each
+       observed fusion from its exit."""
+    partners = {}
+    for first, second in fusions:
+        partners.setdefault(first, []).append(second)
+        if second != first:
+            partners.setdefault(second, []).append(first)
+    table = {}
+    for token in tokens:
+        following = [token + 1] if token + 1 in tokens else []
+        following += [entry_token(end)
+                      for end in partners.get(exit_end(token), [])]
+        table[token] = sorted(set(following))
+    return table
+
+def iter_reconstructions(counts, fusions, alphabet = None):
+    """Yields each chromosome (as a ChromCode) that uses every segment
+       exactly as many times as counts says, and whose fusions are
+       exactly fusions. counts is a dict, or (segment, count) pairs;
+       fusions is a collection of (end, end) pairs, as from
+       identifiability.junction."""
+    remaining = dict(counts)
+    observed = frozenset(fusions)
+    total = sum(remaining.values())
+    if total == 0:
+        if len(observed) == 0:
+            yield idf.ChromCode.from_canonical((), alphabet)
+        return
+
+    tokens = set(s for s, n in remaining.items() if n > 0)
+    tokens |= set(-s for s in tokens)
+    following = successor_table(tokens, observed)
+
+    path = []
+    used = {}
+
+    def extend(token):
+        path.append(token)
+        remaining[abs(token)] -= 1
+        if len(path) > 1:
+            key = idf.junction(path[-2], token)
+            if key != None:
+                used[key] = used.get(key, 0) + 1
+
+    def retract():
+        token = path.pop()
+        remaining[abs(token)] += 1
+        if len(path) > 0:
+            key = idf.junction(path[-1], token)
+            if key != None:
+                used[key] -= 1
+                if used[key] == 0:
+                    del used[key]
+
+    # stack[i] iterates over the candidates for path[i].
+    stack = [iter(sorted(tokens))]
+    while stack:
+        token = next(stack[-1], None)
+        if token == None:
+            stack.pop()
+            if path:
+                retract()
+            continue
+        if remaining[abs(token)] == 0:
+            continue
+        if path:
+            key = idf.junction(path[-1], token)
+            if key != None and key not in observed:
+                continue
+
+        extend(token)
+        left = total - len(path)
+        unused = len(observed) - len(used)
+        if left == 0:
+            if unused == 0:
+                signed = tuple(path)
+                if idf.canonical(signed) == signed:
+                    yield idf.ChromCode.from_canonical(signed, alphabet)
+            retract()
+        elif unused > left:
+            retract()
+        else:
+            stack.append(iter(following[token]))
+
+def reconstruct(counts, fusions, limit = None, alphabet = None):
+    """List of the chromosomes of iter_reconstructions, or of the
+       first limit found."""
+    found = iter_reconstructions(counts, fusions, alphabet)
+    if limit != None:
+        found = it.islice(found, limit)
+    return list(found)
+
+### Sample data ###
+
+def sample_signature(fusions, x, cn):
+    """Segments, segment counts and fusions, for reconstruct, from a
+       sample's fusions on one chromosome (a list of Fusions or an
+       sv_data.FusionTable) and its copy number (x, cn as from
+       sv_data.get_x_cn). Segments run between breakpoints, and out to
+       the ends of the copy number data; they are numbered from 1, and
+       their count is their median CN, rounded. Returns a
+       segments.Reference of the segments (named by number; pass its
+       names to reconstruct as the alphabet), a dict of counts and a
+       set of fusions."""
+    x = np.asarray(x)
+    cn = np.asarray(cn, dtype = float)
+    breakpoints = [(bp.pos, bp.strand) for f in fusions
+                                       for bp in (f.bp1, f.bp2)]
+
+    # A '+' breakpoint is the last base of a segment, a '-' breakpoint
+    # the first.
+    def boundary(pos, strand):
+        return int(pos) + 1 if strand == "+" else int(pos)
+
+    bounds = set(boundary(pos, strand) for pos, strand in breakpoints)
+    if len(x):
+        bounds |= set([int(x.min()), int(x.max()) + 1])
+    bounds = np.array(sorted(bounds), dtype = np.int64)
+    numbers = range(1, len(bounds))
+    reference = segments.Reference(map(str, numbers),
+                                   bounds[:-1], bounds[1:])
+
+    counts = {}
+    for number, start, end in zip(numbers, bounds[:-1], bounds[1:]):
+        inside = cn[(x >= start) & (x < end)]
+        counts[number] = int(round(np.median(inside))) if len(inside) else 0
+
+    index = dict((b, i) for i, b in enumerate(bounds))
+    def end_number(pos, strand):
+        if strand == "+":
+            return 2 * index[boundary(pos, strand)] + 1
+        else:
+            return 2 * (index[boundary(pos, strand)] + 1)
+
+    observed = set()
+    for f in fusions:
+        ends = sorted([end_number(f.bp1.pos, f.bp1.strand),
+                       end_number(f.bp2.pos, f.bp2.strand)])
+        observed.add(tuple(ends))
+    return reference, counts, observed
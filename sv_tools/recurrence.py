@@ -0,0 +1,166 @@
+"""
+Recurrent breakpoints and fusions across a cohort of samples.
+
+Breakpoints from all samples are sorted once by (chromosome, strand,
+position) and swept in order: a new cluster starts whenever the
+chromosome or strand changes, or the gap to the previous breakpoint
+exceeds the tolerance (so clusters are chains of breakpoints at most
+tolerance bp apart, as in "bedtools merge -d"). A fusion cluster is a
+pair of breakpoint clusters. Everything is done with sorts and cumulative
+sums over arrays, in O(n log n), without pairwise comparisons.
+
+Samples are given as a dict mapping sample names to lists of Fusions or
+to sv_data.FusionTables.
+"""
+
+import numpy as np
+import pandas as pd
+
+import sv_data
+
+def cohort_fusions(samples):
+    """One data frame of the fusions of all samples, with a sample
+       column. The ends of each fusion are ordered by (chrom, pos), so
+       that the same fusion has the same ends in every sample."""
+    frames = []
+    for name in sorted(samples):
+        table = sv_data.FusionTable.from_fusions(samples[name])
+        frame = table.data[sv_data.FusionTable.columns].copy()
+        frame['sample'] = name
+        frames.append(frame)
+    if len(frames) == 0:
+        frames = [pd.DataFrame(columns = sv_data.FusionTable.columns +
+                                         ['sample'])]
+    cohort = pd.concat(frames, ignore_index = True)
+
+    # FusionTable orders the ends by position alone, whatever their
+    # chromosomes.
+    chrom1 = cohort['chrom1'].values.astype(str)
+    chrom2 = cohort['chrom2'].values.astype(str)
+    pos1 = cohort['pos1'].values
+    pos2 = cohort['pos2'].values
+    swap = (chrom2 < chrom1) | ((chrom2 == chrom1) & (pos2 < pos1))
+    for field in ['chrom', 'pos', 'strand']:
+        first = cohort[field + '1'].values.copy()
+        second = cohort[field + '2'].values.copy()
+        cohort[field + '1'] = np.where(swap, second, first)
+        cohort[field + '2'] = np.where(swap, first, second)
+
+    cohort['sample'] = cohort['sample'].astype('category')
+    return cohort
+
+def cluster_ids(chroms, strands, positions, tolerance, strand_aware = True):
+    """Sweep-line clustering. Returns an array giving the cluster of
+       each breakpoint, numbered in (chrom, strand, pos) order."""
+    chrom_codes = pd.factorize(chroms, sort = True)[0]
+    positions = np.asarray(positions, dtype = np.int64)
+    if len(positions) == 0:
+        return np.zeros(0, dtype = np.int64)
+    if strand_aware:
+        strand_codes = pd.factorize(strands, sort = True)[0]
+    else:
+        strand_codes = np.zeros(len(positions), dtype = int)
+
+    # A single int64 sort key is much faster than np.lexsort.
+    # Positions must fit in 32 bits, which chromosomes do.
+    group = chrom_codes.astype(np.int64) * (strand_codes.max() + 1) + \
+            strand_codes
+    order = np.argsort((group << 32) + positions, kind = 'mergesort')
+    new_cluster = ((np.diff(chrom_codes[order]) != 0) |
+                   (np.diff(strand_codes[order]) != 0) |
+                   (np.diff(positions[order]) > tolerance))
+
+    ids = np.empty(len(positions), dtype = np.int64)
+    ids[order] = np.concatenate([[0], np.cumsum(new_cluster)])
+    return ids
+
+def summarise_clusters(frame, cluster, fields):
+    """Per-cluster table: the first value of each field, the number of
+       rows and the number of distinct samples."""
+    grouped = frame.groupby(cluster, sort = True)
+    table = grouped[fields].first()
+    table['n'] = grouped.size()
+    distinct = frame[[cluster, 'sample']].drop_duplicates()
+    table['n_samples'] = distinct.groupby(cluster).size()
+    table.index.name = cluster
+    return table
+
+def cohort_breakpoints(cohort, tolerance, strand_aware):
+    """Clustered breakpoints of a cohort_fusions() data frame, bp1s
+       first and then bp2s."""
+    ends = []
+    for end in ['1', '2']:
+        frame = pd.DataFrame({'sample': cohort['sample'],
+                              'fusion': np.arange(len(cohort)),
+                              'end': int(end),
+                              'chrom': cohort['chrom' + end],
+                              'pos': cohort['pos' + end],
+                              'strand': cohort['strand' + end]},
+                             columns = ['sample', 'fusion', 'end',
+                                        'chrom', 'pos', 'strand'])
+        ends.append(frame)
+    bps = pd.concat(ends, ignore_index = True)
+    bps['cluster'] = cluster_ids(bps['chrom'].values, bps['strand'].values,
+                                 bps['pos'].values, tolerance, strand_aware)
+    return bps
+
+def breakpoint_clusters(samples, tolerance = 0, strand_aware = True):
+    """Data frame with one row per breakpoint in the cohort
+       (sample, fusion, end, chrom, pos, strand) and its cluster."""
+    return cohort_breakpoints(cohort_fusions(samples),
+                              tolerance, strand_aware)
+
+def recurrent_breakpoints(samples, tolerance = 0, strand_aware = True,
+                          min_samples = 1):
+    """Recurrence table of breakpoint clusters: chrom, strand (if
+       strand_aware), start, end, number of breakpoints (n) and number
+       of samples (n_samples)."""
+    bps = breakpoint_clusters(samples, tolerance, strand_aware)
+    fields = ['chrom', 'strand'] if strand_aware else ['chrom']
+    table = summarise_clusters(bps, 'cluster', fields)
+    grouped = bps.groupby('cluster')['pos']
+    table['start'] = grouped.min()
+    table['end'] = grouped.max()
+    table = table[fields + ['start', 'end', 'n', 'n_samples']]
+    return table[table['n_samples'] >= min_samples]
+
+def fusion_clusters(samples, tolerance = 0, strand_aware = True):
+    """Data frame with one row per fusion in the cohort, with the
+       breakpoint clusters of each end (cluster1, cluster2) and the
+       fusion cluster."""
+    cohort = cohort_fusions(samples)
+    bps = cohort_breakpoints(cohort, tolerance, strand_aware)
+    n_fusions = len(cohort)
+    cohort['cluster1'] = bps['cluster'].values[:n_fusions]
+    cohort['cluster2'] = bps['cluster'].values[n_fusions:]
+
+    pair = (cohort['cluster1'].values * (bps['cluster'].max() + 1) +
+            cohort['cluster2'].values)
+    cohort['cluster'] = pd.factorize(pair, sort = True)[0]
+    return cohort
+
+def recurrent_fusions(samples, tolerance = 0, strand_aware = True,
+                      min_samples = 1):
+    """Recurrence table of fusion clusters: the breakpoint cluster
+       bounds of both ends, the fusion type (if strand_aware), number
+       of fusions (n) and number of samples (n_samples)."""
+    fs = fusion_clusters(samples, tolerance, strand_aware)
+    if strand_aware:
+        fields = ['chrom1', 'strand1', 'chrom2', 'strand2']
+    else:
+        fields = ['chrom1', 'chrom2']
+    table = summarise_clusters(fs, 'cluster', fields)
+
+    grouped = fs.groupby('cluster')
+    for end in ['1', '2']:
+        table['start' + end] = grouped['pos' + end].min()
+        table['end' + end] = grouped['pos' + end].max()
+
+    columns = ['chrom1', 'start1', 'end1', 'chrom2', 'start2', 'end2']
+    if strand_aware:
+        orientations = (table['strand1'].map(sv_data.orientation_of_strand) +
+                        table['strand2'].map(sv_data.orientation_of_strand))
+        table['type'] = orientations.map(sv_data.fusion_type_of_orientations)
+        columns = columns + ['type']
+    table = table[columns + ['n', 'n_samples']]
+    return table[table['n_samples'] >= min_samples]
@@ -0,0 +1,170 @@
+"""
+A content-addressed cache of rendered diagrams.
+
+Outputs of sv_diagram.plot_sv_diagram and simulator.simulate_sv_diagram
+are stored under a hash of everything that determines them: the input
+data (x, cn, fusions or letters), the keyword arguments, the output
+format, and the source code of the rendering modules (plus the
+matplotlib version). When nothing has changed, the cached file is copied
+to the output instead of being rendered again. The cache is bounded in
+size, evicting the least recently used files first.
+
+    cache = render_cache.RenderCache("~/.sv_tools_render_cache")
+    cache.plot_sv_diagram(x, cn, fusions, "chr12.pdf", logbase = 4)
+    print cache.stats()
+"""
+
+import os
+import shutil
+import hashlib
+import tempfile
+
+import numpy as np
+import matplotlib as mpl
+
+import sv_data
+import sv_diagram as sv_d
+import simulator as sim
+import segments
+
+### Hashing ###
+
+def source_file(module):
+    """The .py file of a module (rather than its .pyc)."""
+    filename = module.__file__
+    if filename.endswith((".pyc", ".pyo")):
+        filename = filename[:-1]
+    return filename
+
+def code_version(modules = (sv_data, sv_d, sim, segments)):
+    """Hash of the source of the modules that do the rendering."""
+    digest = hashlib.sha1(mpl.__version__.encode('utf-8'))
+    for module in modules:
+        with open(source_file(module), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def update_with_array(digest, values):
+    values = np.ascontiguousarray(np.asarray(values))
+    digest.update(str(values.dtype).encode('utf-8'))
+    digest.update(str(values.shape).encode('utf-8'))
+    if values.dtype == object:
+        digest.update(repr(values.tolist()).encode('utf-8'))
+    else:
+        digest.update(values.tobytes())
+
+def update_with_fusions(digest, fusions):
+    data = sv_data.FusionTable.from_fusions(fusions).data
+    for column in sv_data.FusionTable.columns:
+        update_with_array(digest, data[column].values)
+
+def update_with_kwargs(digest, kwargs):
+    digest.update(repr(sorted(kwargs.items())).encode('utf-8'))
+
+### The cache ###
+
+class RenderCache(object):
+    """A directory of rendered outputs, named by their content key, of at
+       most max_bytes in total."""
+
+    def __init__(self, directory, max_bytes = 1 << 30):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        self.version = code_version()
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def entry(self, key, outfile):
+        extension = os.path.splitext(outfile)[1]
+        return os.path.join(self.directory, key + extension)
+
+    def render(self, digest, outfile, render_function):
+        """Copies the entry for digest to outfile if there is one;
+           otherwise calls render_function(outfile) and stores the
+           result. Returns True on a cache hit."""
+        entry = self.entry(digest.hexdigest(), outfile)
+        if os.path.exists(entry):
+            shutil.copyfile(entry, outfile)
+            os.utime(entry, None) # Marks it as recently used.
+            self.hits += 1
+            return True
+
+        render_function(outfile)
+        self.misses += 1
+
+        # Copy in under a temporary name, so entries are always whole.
+        handle, temporary = tempfile.mkstemp(dir = self.directory)
+        os.close(handle)
+        shutil.copyfile(outfile, temporary)
+        os.rename(temporary, entry)
+        self.evict()
+        return False
+
+    def entries(self):
+        """(last use, size, path) of each entry, least recent first."""
+        found = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if os.path.isfile(path):
+                st = os.stat(path)
+                found.append((st.st_mtime, st.st_size, path))
+        return sorted(found)
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits
+           in max_bytes."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            os.remove(path)
+
+    def stats(self):
+        entries = self.entries()
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / float(lookups) if lookups else 0.,
+                'entries': len(entries),
+                'bytes': sum(size for _, size, _ in entries)}
+
+    ## Cached versions of the rendering functions ##
+
+    def new_digest(self, kind, outfile, kwargs):
+        digest = hashlib.sha1(self.version.encode('utf-8'))
+        digest.update(kind.encode('utf-8'))
+        digest.update(os.path.splitext(outfile)[1].encode('utf-8'))
+        update_with_kwargs(digest, kwargs)
+        return digest
+
+    def plot_sv_diagram(self, x, cn, fusions, outfile, **kwargs):
+        """sv_diagram.plot_sv_diagram, through the cache."""
+        digest = self.new_digest("plot_sv_diagram", outfile, kwargs)
+        update_with_array(digest, x)
+        update_with_array(digest, cn)
+        update_with_fusions(digest, fusions)
+
+        def render_function(outfile):
+            sv_d.plot_sv_diagram(x, cn, fusions, outfile, **kwargs)
+
+        return self.render(digest, outfile, render_function)
+
+    def simulate_sv_diagram(self, letters, outfile = None, **kwargs):
+        """simulator.simulate_sv_diagram, through the cache."""
+        if outfile == None:
+            outfile = sim.default_outfile % letters
+        digest = self.new_digest("simulate_sv_diagram", outfile, kwargs)
+        digest.update(letters.encode('utf-8'))
+
+        def render_function(outfile):
+            sim.simulate_sv_diagram(letters, outfile, **kwargs)
+
+        return self.render(digest, outfile, render_function)
@@ -0,0 +1,246 @@
+"""
+Rearranged chromosomes as lists of segments of a reference chromosome.
+
+The simulator spells a donor chromosome with one letter per segment,
+e.g. "ACDB'E", and expands each letter into 10 positions. Here a segment
+is an interval [start, end) of the reference instead, so segments can
+have real lengths, and copy number and fusions are found by interval
+arithmetic, at a cost proportional to the number of segments.
+
+Segments are written as in the simulator, with names longer than one
+letter in brackets, e.g. "A[p12]'B" is A, then p12 reverse complemented,
+then B.
+
+    reference = segments.Reference.from_lengths(
+                    [("p1", 2100000), ("p2", 350000), ("p3", 1200000)])
+    chromosome = segments.SegmentChromosome.parse("[p1][p3][p2]'", reference)
+    fusions = chromosome.fusions()
+    bounds, cn = chromosome.cn_profile()
+"""
+
+import re
+
+import numpy as np
+import pandas as pd
+
+import sv_data
+
+### Notation ###
+
+token_pattern = re.compile(r"(\[[^\[\]]+\]|[A-Za-z])('?)")
+
+def parse_tokens(text):
+    """Splits a chromosome string into tokens, such as "A", "B'" or
+       "[p12]'". Other characters are ignored."""
+    return [name + tick for name, tick in token_pattern.findall(text)]
+
+def token_name(token):
+    name = token.rstrip("'")
+    if name.startswith("["):
+        name = name[1:-1]
+    return name
+
+def token_inverted(token):
+    return token.endswith("'")
+
+def name_token(name, inverted = False):
+    if len(name) == 1 and name.isalpha():
+        token = name
+    else:
+        token = "[%s]" % name
+    if inverted:
+        token += "'"
+    return token
+
+def natural_key(name):
+    """Sort key putting "p2" before "p10"."""
+    return [int(part) if part.isdigit() else part
+            for part in re.split(r"(\d+)", name)]
+
+### Reference ###
+
+class Reference(object):
+    """Named segments of a reference chromosome, each an interval
+       [start, end)."""
+
+    def __init__(self, names, starts, ends):
+        self.names = list(names)
+        self.starts = np.asarray(starts, dtype = np.int64)
+        self.ends = np.asarray(ends, dtype = np.int64)
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+
+    @staticmethod
+    def from_lengths(named_lengths, start = 0):
+        """Consecutive segments, from a list of (name, length) pairs."""
+        if len(named_lengths) == 0:
+            return Reference([], [], [])
+        names, lengths = zip(*named_lengths)
+        ends = start + np.cumsum(np.asarray(lengths, dtype = np.int64))
+        return Reference(names, ends - lengths, ends)
+
+    @staticmethod
+    def for_letters(letters, length = 10):
+        """Single letter segments laid out as in the simulator: each
+           letter from the first to the last (in the alphabet) of
+           letters, at ord(letter) * length. Letters in between that are
+           not used are deleted segments."""
+        codes = [ord(l) for l in letters]
+        if len(codes) == 0:
+            return Reference([], [], [])
+        codes = np.arange(min(codes), max(codes) + 1)
+        return Reference([chr(c) for c in codes],
+                         codes * length, (codes + 1) * length)
+
+    @staticmethod
+    def default(names, length = 10):
+        """The reference assumed when none is given: for single letters,
+           as in for_letters; otherwise, segments of the given length in
+           natural order of their names. Segments that are deleted
+           entirely must then be named in the reference to give the
+           expected fusions."""
+        names = set(names)
+        if all(len(name) == 1 and name.isalpha() for name in names):
+            return Reference.for_letters(names, length)
+        return Reference.from_lengths([(name, length) for name in
+                                       sorted(names, key = natural_key)])
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return "Reference(%r)" % (zip(self.names, self.starts.tolist(),
+                                      self.ends.tolist()),)
+
+### Rearranged chromosomes ###
+
+class SegmentChromosome(object):
+    """A rearranged chromosome: a sequence of reference segments, each
+       either as in the reference or inverted. Create with
+       SegmentChromosome.parse."""
+
+    def __init__(self, reference, segment_ids, inverted):
+        self.reference = reference
+        self.ids = np.asarray(segment_ids, dtype = np.int64)
+        self.inverted = np.asarray(inverted, dtype = bool)
+        self.starts = reference.starts[self.ids]
+        self.ends = reference.ends[self.ids]
+
+    @staticmethod
+    def parse(text, reference = None, length = 10):
+        """A SegmentChromosome from a string like "AB'C" or "[p1][p3]'".
+           Without a reference, Reference.default is used."""
+        tokens = parse_tokens(text)
+        names = [token_name(t) for t in tokens]
+        if reference == None:
+            reference = Reference.default(names, length)
+        missing = [name for name in names if name not in reference.index]
+        if missing:
+            raise ValueError("Segments not in the reference: %s" %
+                             ", ".join(sorted(set(missing))))
+        return SegmentChromosome(reference,
+                                 [reference.index[name] for name in names],
+                                 [token_inverted(t) for t in tokens])
+
+    def tokens(self):
+        return [name_token(self.reference.names[i], inverted)
+                for i, inverted in zip(self.ids, self.inverted)]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __repr__(self):
+        return "".join(self.tokens())
+
+    ## Fusions ##
+
+    def fusion_columns(self, scale = 1):
+        """pos1, strand1, pos2 and strand2 arrays of the fusions between
+           consecutive segments, in the order they are read. A fusion
+           joins the last base of one segment to the first base of the
+           next (in the orientation they are read); junctions that rejoin
+           neighbouring reference bases are not fusions."""
+        left_inverted = self.inverted[:-1]
+        right_inverted = self.inverted[1:]
+
+        pos1 = np.where(left_inverted, self.starts[:-1], self.ends[:-1] - 1)
+        pos2 = np.where(right_inverted, self.ends[1:] - 1, self.starts[1:])
+        rejoined = ((left_inverted == right_inverted) &
+                    (pos2 - pos1 == np.where(left_inverted, -1, 1)))
+        keep = ~rejoined
+
+        return {'pos1': pos1[keep] * scale,
+                'strand1': np.where(left_inverted, "-", "+")[keep],
+                'pos2': pos2[keep] * scale,
+                'strand2': np.where(right_inverted, "+", "-")[keep]}
+
+    def fusion_data(self, chrom = "", scale = 1):
+        """Data frame of fusion_columns, with FusionTable's columns."""
+        data = self.fusion_columns(scale)
+        chroms = np.repeat(chrom, len(data['pos1']))
+        data['chrom1'] = chroms
+        data['chrom2'] = chroms
+        return pd.DataFrame(data, columns = sv_data.FusionTable.columns)
+
+    def fusion_table(self, chrom = "", scale = 1):
+        return sv_data.FusionTable(self.fusion_data(chrom, scale))
+
+    def fusions(self, chrom = "", scale = 1):
+        """List of Fusions. With single letter segments and scale = 1e6,
+           the same as simulator.get_fusions gives."""
+        data = self.fusion_columns(scale)
+        return [sv_data.Fusion(sv_data.Breakpoint(chrom, pos1, strand1),
+                               sv_data.Breakpoint(chrom, pos2, strand2))
+                for pos1, strand1, pos2, strand2 in
+                zip(data['pos1'].tolist(), data['strand1'].tolist(),
+                    data['pos2'].tolist(), data['strand2'].tolist())]
+
+    ## Copy number ##
+
+    def cn_profile(self):
+        """Copy number as a step function: cn[i] is the copy number
+           between bounds[i] and bounds[i + 1]."""
+        bounds = np.unique(np.concatenate([self.starts, self.ends]))
+        n = len(bounds)
+        change = (np.bincount(np.searchsorted(bounds, self.starts),
+                              minlength = n) -
+                  np.bincount(np.searchsorted(bounds, self.ends),
+                              minlength = n))
+        return bounds, np.cumsum(change)[:-1]
+
+    def cn_at(self, positions):
+        """Copy number at each of positions."""
+        bounds, cn = self.cn_profile()
+        index = np.searchsorted(bounds, positions, side = 'right') - 1
+        inside = (index >= 0) & (index < len(cn))
+        return np.where(inside, cn[np.clip(index, 0, max(len(cn) - 1, 0))],
+                        0)
+
+    def default_step(self, n_points = 10000):
+        """A step for x_cn giving about n_points points at most, and at
+           least a point per base."""
+        span = self.ends.max() - self.starts.min() if len(self) else 0
+        return max(1, int(span // n_points))
+
+    def x_cn(self, step = 1):
+        """x and CN points along the rearranged chromosome, one every
+           step bases of each segment. With single letter segments and
+           step = 1, the same as simulator.get_x_cn gives."""
+        lengths = -(-(self.ends - self.starts) // step) # Rounded up.
+        segment = np.repeat(np.arange(len(self)), lengths)
+        offset = (np.arange(lengths.sum()) -
+                  np.repeat(np.cumsum(lengths) - lengths, lengths)) * step
+        x = np.where(self.inverted[segment],
+                     self.ends[segment] - 1 - offset,
+                     self.starts[segment] + offset)
+        return x, self.cn_at(x)
+
+    def reference_ticks(self):
+        """Centres and labels of the reference segments spanned by the
+           chromosome, for labelling the x axis."""
+        reference = self.reference
+        spanned = ((reference.starts >= self.starts.min()) &
+                   (reference.ends <= self.ends.max()))
+        centres = (reference.starts[spanned] + reference.ends[spanned] - 1) / 2.
+        labels = [name_token(name)
+                  for name, s in zip(reference.names, spanned) if s]
+        return centres, labels
@@ -0,0 +1,125 @@
+"""
+Binary sidecar caches for the text inputs read by sv_data.
+
+On first use a text file is parsed once and its columns are written,
+sorted by chromosome, as .npy files in a sidecar directory, together
+with an index of the rows belonging to each chromosome. Later reads
+memory-map the columns and return (copy-free) slices for the requested
+chromosome only. The index records the source file's mtime and size,
+so a sidecar is rebuilt whenever its source changes.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+
+format_version = 1
+
+def sidecar_dir(source, kind, cache_dir = None):
+    """Directory holding the sidecar of a given kind for a source file.
+       By default this sits next to the source."""
+    name = "%s.%s.svcache" % (os.path.basename(source), kind)
+    if cache_dir == None:
+        return os.path.join(os.path.dirname(os.path.abspath(source)), name)
+    else:
+        # Different sources may share a base name.
+        digest = hashlib.md5(os.path.abspath(source).encode('utf-8'))
+        return os.path.join(cache_dir, digest.hexdigest()[:12] + "." + name)
+
+def source_stamp(source):
+    """What the sidecar must agree with to be considered up to date."""
+    st = os.stat(source)
+    return {'version': format_version,
+            'mtime': st.st_mtime,
+            'size': st.st_size}
+
+class replacing(object):
+    """Opens a temporary file in the directory of path, and renames it
+       to path once written, so that readers (and other processes
+       rebuilding the same sidecar) never see part of a file."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        handle, self.temporary = tempfile.mkstemp(
+                                     dir = os.path.dirname(self.path))
+        self.file = os.fdopen(handle, 'wb')
+        return self.file
+
+    def __exit__(self, kind, value, traceback):
+        self.file.close()
+        if kind == None:
+            # mkstemp makes files only the owner can read.
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(self.temporary, 0o666 & ~umask)
+            os.rename(self.temporary, self.path)
+        else:
+            os.remove(self.temporary)
+
+def write_sidecar(directory, stamp, chroms, columns):
+    """Sorts columns (a dict of equal-length arrays) by chromosome and
+       writes them, followed by the index, to directory."""
+    chroms = np.asarray(chroms).astype(str)
+    order = np.argsort(chroms, kind = 'mergesort')
+    sorted_chroms = chroms[order]
+    names, starts = np.unique(sorted_chroms, return_index = True)
+    stops = np.append(starts[1:], len(sorted_chroms))
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    for name, column in columns.items():
+        with replacing(os.path.join(directory, name + ".npy")) as f:
+            np.save(f, np.asarray(column)[order])
+
+    index = dict(stamp)
+    index['columns'] = sorted(columns)
+    index['chroms'] = dict((str(c), [int(start), int(stop)])
+                           for c, start, stop in zip(names, starts, stops))
+
+    # The index is written last, and atomically, so that a sidecar
+    # with an index is always complete.
+    with replacing(os.path.join(directory, "index.json")) as f:
+        json.dump(index, f)
+
+def read_index(directory, stamp):
+    """The sidecar index, or None if it is missing or stale."""
+    try:
+        with open(os.path.join(directory, "index.json")) as f:
+            index = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if any(index.get(key) != value for key, value in stamp.items()):
+        return None
+    return index
+
+def chrom_columns(source, kind, chrom, read_columns, cache_dir = None):
+    """Returns a dict of memory-mapped column slices for chrom.
+
+       read_columns(source) must return (chroms, columns): the chromosome
+       of each row and a dict of column arrays. It is only called when
+       the sidecar is missing or out of date. Columns must not have
+       object dtype."""
+    directory = sidecar_dir(source, kind, cache_dir)
+    stamp = source_stamp(source)
+
+    index = read_index(directory, stamp)
+    if index == None:
+        chroms, columns = read_columns(source)
+        write_sidecar(directory, stamp, chroms, columns)
+        index = read_index(directory, stamp)
+
+    start, stop = index['chroms'].get(str(chrom), (0, 0))
+
+    def column(name):
+        mapped = np.load(os.path.join(directory, name + ".npy"),
+                         mmap_mode = 'r')
+        return mapped[start:stop]
+
+    return dict((name, column(name)) for name in index['columns'])
@@ -1,7 +1,7 @@
 import numpy as np
 
 import sv_data
-import sv_diagram as sv_d
+import segments
 
 def map_kmers(f, k):
     """ Takes a list function f and returns a function that applies
@@ -122,24 +122,133 @@ get_fusions = map_kmers(detect_fusions, 4)
 # Copy number from rearranged chromosome
 
 def get_x_cn(positions):
-    counts = [(p, positions.count(p)) for p in positions]
-    x_tuple, cn_tuple = zip(*counts)
-    x, cn = list(x_tuple), list(cn_tuple)
-    return x, cn
+    _, cn = get_x_cn_array(np.asarray(positions))
+    return list(positions), cn.tolist()
+
+## Array engine ##
+#
+# The functions above work on lists, one k-mer at a time. Those below do
+# the same on integer position arrays, and on batches of rearranged
+# chromosomes, given as a list of arrays or as a 2-D array padded at the
+# end of each row with -1.
+
+strand_of_diff = np.array(["?", "+", "-"]) # Indexed by code below.
+
+def letters_to_position_array(letters, length = 10):
+    """letters_to_positions, as an integer array."""
+    tokens = letters_to_letterlist(letters)
+    bases = np.array([ord(t[0]) * length for t in tokens], dtype = np.int64)
+    inverted = np.array([len(t) == 2 for t in tokens])
+    offsets = np.arange(length)
+    within = np.where(inverted[:, None], offsets[::-1], offsets)
+    return (bases[:, None] + within).ravel()
+
+def get_x_cn_array(positions):
+    """get_x_cn for a position array: the CN at each position is the
+       number of times it occurs, found with np.bincount."""
+    if len(positions) == 0:
+        return positions, np.zeros(0, dtype = np.int64)
+    shifted = positions - positions.min()
+    return positions, np.bincount(shifted)[shifted]
+
+def fusion_columns_array(positions, chrom_ids = None):
+    """get_fusions for a position array, as columns: pos1, strand1,
+       pos2, strand2 (ordered as in Fusion) and the index (into
+       positions) of the junction. A junction between positions j and
+       j + 1 is detected, as in detect_fusions, when they are not
+       adjacent and positions j - 1 and j + 2 exist (on the same
+       chromosome, if chrom_ids are given)."""
+    n = len(positions)
+    j = np.arange(1, max(n - 2, 1))
+    if n < 4:
+        j = j[:0]
+    junction = np.abs(positions[j] - positions[j + 1]) != 1
+    if chrom_ids is not None:
+        junction &= chrom_ids[j - 1] == chrom_ids[j + 2]
+    j = j[junction]
+
+    diff1 = positions[j - 1] - positions[j]
+    diff2 = positions[j + 1] - positions[j + 2]
+    # Codes: 1 for "+", 2 for "-", 0 for "?".
+    code1 = np.where(diff1 == -1, 1, np.where(diff1 == 1, 2, 0))
+    code2 = np.where(diff2 == 1, 1, np.where(diff2 == -1, 2, 0))
+
+    left, right = positions[j], positions[j + 1]
+    swap = right < left
+    return {'pos1': np.where(swap, right, left) * 1e6,
+            'strand1': strand_of_diff[np.where(swap, code2, code1)],
+            'pos2': np.where(swap, left, right) * 1e6,
+            'strand2': strand_of_diff[np.where(swap, code1, code2)],
+            'junction': j}
+
+def fusions_from_columns(columns):
+    """Fusion objects, as from get_fusions, from fusion columns."""
+    return [sv_data.Fusion(sv_data.Breakpoint("", pos1, strand1),
+                           sv_data.Breakpoint("", pos2, strand2))
+            for pos1, strand1, pos2, strand2 in
+            zip(columns['pos1'].tolist(), columns['strand1'].tolist(),
+                columns['pos2'].tolist(), columns['strand2'].tolist())]
+
+def ragged(batch):
+    """A batch of position arrays (a list of arrays, or a 2-D array
+       padded with -1) as one concatenated array, the index of the
+       chromosome of each position, and offsets such that chromosome i
+       is at offsets[i]:offsets[i + 1]."""
+    if isinstance(batch, np.ndarray) and batch.ndim == 2:
+        lengths = (batch >= 0).sum(axis = 1)
+        positions = batch[batch >= 0]
+    else:
+        arrays = [np.asarray(p, dtype = np.int64) for p in batch]
+        lengths = np.array([len(p) for p in arrays], dtype = np.int64)
+        positions = (np.concatenate(arrays) if arrays
+                     else np.zeros(0, dtype = np.int64))
+    chrom_ids = np.repeat(np.arange(len(lengths)), lengths)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    return positions, chrom_ids, offsets
+
+def batch_x_cn(batch):
+    """get_x_cn_array for a batch of chromosomes at once. Returns the
+       concatenated x and CN arrays, and offsets as in ragged()."""
+    positions, chrom_ids, offsets = ragged(batch)
+    if len(positions) == 0:
+        return positions, np.zeros(0, dtype = np.int64), offsets
+    span = positions.max() - positions.min() + 1
+    key = chrom_ids * span + (positions - positions.min())
+    return positions, np.bincount(key)[key], offsets
+
+def batch_fusion_columns(batch):
+    """fusion_columns_array for a batch of chromosomes at once, with an
+       extra column giving the chromosome (index in the batch) of each
+       fusion."""
+    positions, chrom_ids, offsets = ragged(batch)
+    columns = fusion_columns_array(positions, chrom_ids)
+    columns['chrom'] = chrom_ids[columns['junction']]
+    columns['junction'] = columns['junction'] - offsets[columns['chrom']]
+    return columns
 
 ## Campbellgrams ##
 
+default_outfile = "../output/simulation/simulation_%s.pdf"
+
 def simulate_sv_diagram(
-        letters, outfile = None,
+        letters, outfile = None, reference = None, step = None,
         **kwargs):
+    """Plots the diagram of a donor chromosome such as "ACDB'E", or with
+       segments of a segments.Reference, such as "[p1][p3][p2]'". Copy
+       number is drawn every step bases (by default, about 10000 points
+       in all)."""
+    # Imported here so the simulation itself doesn't load matplotlib.
+    import sv_diagram as sv_d
 
     if outfile == None:
-        outfile = "../output/simulation/simulation_%s.pdf" % letters
+        outfile = default_outfile % letters
 
     ### Simulation-specific stuff
-    positions = letters_to_positions(letters)
-    fusions = get_fusions(positions)
-    x, cn = get_x_cn(positions)
+    chromosome = segments.SegmentChromosome.parse(letters, reference)
+    if step == None:
+        step = chromosome.default_step()
+    fusions = chromosome.fusion_table(scale = 1e6)
+    x, cn = chromosome.x_cn(step)
     kwargs['yticks'] = range(max(cn) + 2)
     kwargs['ymax'] = max(cn) + 1
     kwargs['ymin'] = 0
@@ -159,9 +268,7 @@ def simulate_sv_diagram(
 
 
     ### Simulation-specific stuff
-    x_range = range(min(x), max(x) + 1)
-    x_letters = letters_to_letterlist(positions_to_letters(x_range))
-    x_ticks = positions_to_ticks(x_range)
+    x_ticks, x_letters = chromosome.reference_ticks()
     cn_axes.set_xticks(x_ticks, minor = True)
     cn_axes.set_xticklabels(x_letters, minor = True)
 
@@ -172,8 +279,7 @@ def simulate_sv_diagram(
     # Fusions
 
     sv_d.setup_fusion_axes(fusion_axes, min(x), max(x))
-    for fusion in fusions:
-        sv_d.plot_fusion(cn_axes, fusion_axes, fusion)
+    sv_d.plot_fusions(cn_axes, fusion_axes, fusions)
 
     # Ensure everything fits
     sv_d.plt.tight_layout()
@@ -1,18 +1,37 @@
+import gzip
+import re
+
 import pandas as pd
+import numpy as np
+
+import sidecar
 
 ### Main classes ###
 
+orientation_of_strand = {'+': 'T', '-': 'H'}
+
+fusion_type_of_orientations = {"TH": "D",
+                               "HT": "TD",
+                               "HH": "HH",
+                               "TT": "TT"}
+
 class Breakpoint(object):
     """A Breakpoint is essentially a chromosomal coordinate with an
-       orientation."""
+       orientation. Breakpoints are treated as immutable values: the
+       hash is computed once, in the constructor."""
+
+    __slots__ = ['chrom', 'pos', 'strand', '_key', '_hash']
+
     def __init__(self, chrom, pos, strand):
         self.chrom = chrom
         self.pos = pos
         self.strand = strand
+        self._key = (chrom, pos, strand)
+        self._hash = hash(self._key)
 
     def orientation(self):
         """Orientation, as determined by strand."""
-        return {'+': 'T', '-': 'H'}.get(self.strand)
+        return orientation_of_strand.get(self.strand)
 
     def pos_scaled(self):
         """Position in Mb."""
@@ -25,20 +44,34 @@ class Breakpoint(object):
 
     # Allows "=="
     def __eq__(self, other):
-        return self.__dict__ == other.__dict__
+        if not isinstance(other, Breakpoint):
+            return NotImplemented
+        return self._key == other._key
+    def __ne__(self, other):
+        return not self == other
     # Allows set() to determine equality.
     def __hash__(self):
-            return hash(self.__repr__())
+        return self._hash
+
+    # Slotted classes need help to pickle (e.g. for multiprocessing).
+    def __reduce__(self):
+        return (Breakpoint, self._key)
 
 class Fusion(object):
-    """A Fusion is a pair of breakpoints."""
+    """A Fusion is a pair of breakpoints. Like Breakpoints, Fusions are
+       treated as immutable values."""
+
+    __slots__ = ['bp1', 'bp2', '_key', '_hash']
+
     def __init__(self, first_bp, second_bp):
-        ordered = sorted([first_bp, second_bp],
-                         key = lambda x: x.pos)
-        self.bp1 = ordered[0]
-        self.bp2 = ordered[1]
+        if second_bp.pos < first_bp.pos:
+            first_bp, second_bp = second_bp, first_bp
+        self.bp1 = first_bp
+        self.bp2 = second_bp
         # self.reads = reads  # Not used
         # self.gap = gap      # Not used
+        self._key = (first_bp._key, second_bp._key)
+        self._hash = hash(self._key)
 
     def orientations(self):
         """Fusion type in TH/HT/HH/TT form."""
@@ -46,10 +79,7 @@ class Fusion(object):
 
     def type(self):
         """Fusion type in D/TD/HH/TT form."""
-        return {"TH": "D",
-                "HT": "TD",
-                "HH": "HH",
-                "TT": "TT"}.get(self.orientations())
+        return fusion_type_of_orientations.get(self.orientations())
 
     def __repr__(self):
         # Ugly!
@@ -57,10 +87,100 @@ class Fusion(object):
 
     # Allows "=="
     def __eq__(self, other):
-        return self.__dict__ == other.__dict__
+        if not isinstance(other, Fusion):
+            return NotImplemented
+        return self._key == other._key
+    def __ne__(self, other):
+        return not self == other
     # Allows set() to determine equality.
     def __hash__(self):
-            return hash(self.__repr__())
+        return self._hash
+
+    def __reduce__(self):
+        return (Fusion, (self.bp1, self.bp2))
+
+
+class FusionTable(object):
+    """A column-oriented collection of fusions, backed by a Pandas data
+       frame. Breakpoints are put in canonical (bp1, bp2) order and
+       orientations and types are computed once, for all rows at a time.
+       Fusion objects are only created when the table is iterated over."""
+
+    columns = ['chrom1', 'pos1', 'strand1', 'chrom2', 'pos2', 'strand2']
+
+    def __init__(self, fusion_data):
+        data = fusion_data[self.columns].reset_index(drop = True)
+
+        # Same ordering as Fusion: bp1 is the breakpoint with the
+        # lower position, ties keep the order given.
+        swap = (data['pos2'] < data['pos1']).values
+        for field in ['chrom', 'pos', 'strand']:
+            first = data[field + '1'].values.copy()
+            second = data[field + '2'].values.copy()
+            data[field + '1'] = np.where(swap, second, first)
+            data[field + '2'] = np.where(swap, first, second)
+
+        data['orientations'] = (data['strand1'].map(orientation_of_strand) +
+                                data['strand2'].map(orientation_of_strand))
+        data['type'] = data['orientations'].map(fusion_type_of_orientations)
+        self.data = data
+
+    @staticmethod
+    def from_file(filename):
+        return FusionTable(df_from_txt(filename))
+
+    @staticmethod
+    def from_fusions(fusions):
+        """A FusionTable from a list of Fusions, or a FusionTable."""
+        if isinstance(fusions, FusionTable):
+            return fusions
+        rows = [(f.bp1.chrom, f.bp1.pos, f.bp1.strand,
+                 f.bp2.chrom, f.bp2.pos, f.bp2.strand) for f in fusions]
+        return FusionTable(pd.DataFrame.from_records(
+                                rows, columns = FusionTable.columns))
+
+    def subset(self, mask):
+        """Returns a FusionTable of the rows selected by a boolean mask."""
+        table = FusionTable.__new__(FusionTable)
+        table.data = self.data[np.asarray(mask)].reset_index(drop = True)
+        return table
+
+    def chrom_mask(self, chrom):
+        """Boolean mask of fusions with both breakpoints on chrom."""
+        return ((self.data['chrom1'] == chrom) &
+                (self.data['chrom2'] == chrom)).values
+
+    def on_chrom(self, chrom):
+        """Fusions with both breakpoints on a given chromosome."""
+        return self.subset(self.chrom_mask(chrom))
+
+    def types(self):
+        """pd.Series of fusion types in D/TD/HH/TT form."""
+        return self.data['type']
+
+    def breakpoint_data(self):
+        """Data frame of breakpoints, two rows per fusion, in the
+           order (bp1, bp2) of each fusion in turn."""
+        def interleave(field):
+            return np.column_stack([self.data[field + '1'].values,
+                                    self.data[field + '2'].values]).ravel()
+
+        return pd.DataFrame({'chrom': interleave('chrom'),
+                             'pos': interleave('pos'),
+                             'strand': interleave('strand')},
+                            columns = ['chrom', 'pos', 'strand'])
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        rows = zip(*[self.data[c].tolist() for c in self.columns])
+        for chrom1, pos1, strand1, chrom2, pos2, strand2 in rows:
+            yield Fusion(Breakpoint(chrom1, pos1, strand1),
+                         Breakpoint(chrom2, pos2, strand2))
+
+    def __repr__(self):
+        return "FusionTable(%d fusions)" % len(self)
 
 
 def df_from_txt(txt_file):
@@ -84,40 +204,231 @@ def fusions(fusion_data):
     """Returns a list of Fusions from a Pandas dataframe of
        fusions, possibly restricting attention to one chromosome."""
 
-    fusion_series = fusion_data.apply(fusion_from_row, axis = 1)
-    return list(fusion_series)
+    return list(FusionTable(fusion_data))
+
+def breakpoints_from_data(breakpoint_data):
+    """Returns a list of Breakpoints from a Pandas dataframe
+       with chrom, pos and strand columns."""
+
+    return [Breakpoint(chrom, pos, strand)
+            for chrom, pos, strand in zip(breakpoint_data['chrom'].tolist(),
+                                          breakpoint_data['pos'].tolist(),
+                                          breakpoint_data['strand'].tolist())]
 
 def breakpoints(fusion_data):
     """Returns a list of Breakpoints from a Pandas dataframe
        of fusions."""
 
-    return [bp for fusion in fusions(fusion_data)
-               for bp in (fusion.bp1, fusion.bp2)]
+    return breakpoints_from_data(FusionTable(fusion_data).breakpoint_data())
 
 # Convenience functions
+#
+# Each of these takes an optional cache argument. If it is True, the
+# file is converted into a binary sidecar (see sidecar.py) on first
+# read, next to the file; if it is a directory name, the sidecar is
+# kept there instead. Later reads only map the requested chromosome.
+
+def cache_dir_of(cache):
+    return None if cache is True else cache
+
+def fusion_columns(filename):
+    """Fusion columns for the sidecar cache, keyed by chrom1."""
+    data = FusionTable.from_file(filename).data
+    columns = dict((c, data[c].values.astype(str))
+                   for c in ['strand1', 'chrom2', 'strand2'])
+    columns['pos1'] = data['pos1'].values.astype(np.int64)
+    columns['pos2'] = data['pos2'].values.astype(np.int64)
+    return data['chrom1'].values, columns
+
+def breakpoint_columns(filename):
+    """Breakpoint columns for the sidecar cache, sorted by position
+       within each chromosome."""
+    all_breaks = FusionTable.from_file(filename).breakpoint_data()
+    sorted_breaks = all_breaks.sort_values('pos', kind = 'mergesort')
+    columns = {'pos': sorted_breaks['pos'].values.astype(np.int64),
+               'strand': sorted_breaks['strand'].values.astype(str)}
+    return sorted_breaks['chrom'].values, columns
+
+def get_fusion_table(filename, chrom, cache = False):
+    """Get a FusionTable for a given chromosome from a file."""
+    if not cache:
+        return FusionTable.from_file(filename).on_chrom(chrom)
+
+    columns = sidecar.chrom_columns(filename, 'fusions', chrom,
+                                    fusion_columns, cache_dir_of(cache))
+    data = pd.DataFrame(columns)
+    data['chrom1'] = chrom
+    return FusionTable(data).on_chrom(chrom)
 
-def get_fusions(filename, chrom):
+def get_fusions(filename, chrom, cache = False):
     """Get the fusions for a given chromosome from a file."""
-    fs = fusions(df_from_txt(filename))
-    return [f for f in fs if f.bp1.chrom == chrom and
-                             f.bp2.chrom == chrom]
+    return list(get_fusion_table(filename, chrom, cache))
 
-def get_breakpoints(filename, chrom):
+def get_breakpoints(filename, chrom, cache = False):
     """Get the breakpoints for a given chromosome from a file."""
-    all_breaks = breakpoints(df_from_txt(filename))
-    breaks = [bp for bp in all_breaks if bp.chrom == chrom]
-    sorted_breaks = sorted(breaks, key = lambda x: x.pos)
-    return sorted_breaks
+    if cache:
+        columns = sidecar.chrom_columns(filename, 'breakpoints', chrom,
+                                        breakpoint_columns,
+                                        cache_dir_of(cache))
+        sorted_breaks = pd.DataFrame(columns)
+        sorted_breaks['chrom'] = chrom
+        return breakpoints_from_data(sorted_breaks)
+
+    all_breaks = FusionTable.from_file(filename).breakpoint_data()
+    breaks = all_breaks[all_breaks['chrom'] == chrom]
+    sorted_breaks = breaks.sort_values('pos', kind = 'mergesort')
+    return breakpoints_from_data(sorted_breaks)
+
+### Reading fusions from VCF
+
+# Breakend ALT notation, e.g. G]chr2:321682] or [chr17:198983[A.
+bnd_alt = re.compile(r"^([^\[\]]*)([\[\]])(.+):(\d+)\2([^\[\]]*)$")
+
+def open_text(filename):
+    """Opens a possibly gzipped text file for reading."""
+    with open(filename, 'rb') as f:
+        magic = f.read(2)
+    if magic == b'\x1f\x8b':
+        return gzip.open(filename, 'rb')
+    else:
+        return open(filename, 'rb')
+
+def info_fields(info):
+    """INFO column as a dict; flags map to True."""
+    fields = {}
+    for field in info.split(";"):
+        key, _, value = field.partition("=")
+        fields[key] = value if value else True
+    return fields
+
+def bnd_to_row(chrom, pos, alt):
+    """Fusion row for a breakend ALT, or None if alt is not a
+       paired breakend."""
+    match = bnd_alt.match(alt)
+    if match == None:
+        return None
+    before, bracket, mate_chrom, mate_pos, after = match.groups()
+    # t[p[ and t]p] keep the sequence left of pos, ]p]t and [p[t the
+    # sequence to its right; [ joins the sequence right of p, ] the
+    # sequence left of it.
+    strand = "+" if before else "-"
+    mate_strand = "-" if bracket == "[" else "+"
+    return (chrom, pos, strand, mate_chrom, int(mate_pos), mate_strand)
+
+def symbolic_to_rows(chrom, pos, info):
+    """Fusion rows for a DEL, DUP or INV described by SVTYPE and END."""
+    fields = info_fields(info)
+    sv_type = str(fields.get("SVTYPE", "")).split(":")[0]
+    if "END" not in fields:
+        return []
+    end = int(fields["END"])
+
+    # POS is the padding base before the event, so the affected
+    # sequence is pos + 1 to end.
+    if sv_type == "DEL":
+        return [(chrom, pos, "+", chrom, end + 1, "-")]
+    elif sv_type == "DUP":
+        # The end of the copy is joined to its start.
+        return [(chrom, pos + 1, "-", chrom, end, "+")]
+    elif sv_type == "INV":
+        # Manta flags which of the two junctions was seen.
+        rows = []
+        if "INV5" not in fields:
+            rows.append((chrom, pos, "+", chrom, end, "+"))
+        if "INV3" not in fields:
+            rows.append((chrom, pos + 1, "-", chrom, end + 1, "-"))
+        return rows
+    else:
+        return []
+
+def vcf_fusion_rows(filename, chrom = None, pass_only = False):
+    """Generator of (chrom1, pos1, strand1, chrom2, pos2, strand2)
+       tuples from a (possibly gzipped) VCF of structural variants.
+
+       Breakend (BND) records are reported once per mated pair, with
+       the lower coordinate first; with pass_only, a pair is reported
+       if either mate passes. DEL, DUP and INV records are converted to
+       their junctions. If chrom is given, only fusions with both
+       breakpoints on chrom are returned, and other records are skipped
+       before being parsed."""
+    if chrom != None:
+        prefix = chrom + "\t"
+    # Mated pairs already reported.
+    seen_pairs = set()
+
+    with open_text(filename) as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            if chrom != None and not line.startswith(prefix):
+                continue
+
+            fields = line.rstrip("\n").split("\t", 8)
+            if pass_only and fields[6] not in ("PASS", "."):
+                continue
+            record_chrom, pos, alts = fields[0], int(fields[1]), fields[4]
+
+            for alt in alts.split(","):
+                if "[" in alt or "]" in alt:
+                    row = bnd_to_row(record_chrom, pos, alt)
+                    if row == None:
+                        continue
+                    if (row[3], row[4]) < (row[0], row[1]):
+                        row = row[3:] + row[:3]
+                    # Whichever mate passes first reports the pair.
+                    if row in seen_pairs:
+                        continue
+                    seen_pairs.add(row)
+                    rows = [row]
+                else:
+                    rows = symbolic_to_rows(record_chrom, pos, fields[7])
+
+                for row in rows:
+                    if chrom == None or row[3] == chrom:
+                        yield row
+
+def vcf_fusions(filename, chrom = None, pass_only = False):
+    """Generator of Fusions from a VCF; see vcf_fusion_rows."""
+    for chrom1, pos1, strand1, chrom2, pos2, strand2 in \
+            vcf_fusion_rows(filename, chrom, pass_only):
+        yield Fusion(Breakpoint(chrom1, pos1, strand1),
+                     Breakpoint(chrom2, pos2, strand2))
+
+def get_vcf_fusion_table(filename, chrom, pass_only = False):
+    """Get a FusionTable for a given chromosome from a VCF."""
+    rows = vcf_fusion_rows(filename, chrom, pass_only)
+    data = pd.DataFrame.from_records(list(rows),
+                                     columns = FusionTable.columns)
+    return FusionTable(data)
 
 ### Getting copy number data
 
-def get_x_cn(filename, chrom):
+def df_from_bed(filename):
+    """Returns a Pandas data frame from a copy number .bed file."""
+    fields = ["chrom", "start", "end", "name", "CN"]
+    return pd.read_csv(filename,
+                       sep = '\t',
+                       names = fields)
+
+def cn_columns(filename):
+    """Copy number columns for the sidecar cache."""
+    df = df_from_bed(filename)
+    columns = {'start': df['start'].values.astype(np.int64),
+               'CN': df['CN'].values.astype(np.float64)}
+    return df['chrom'].values, columns
+
+def get_x_cn(filename, chrom, cache = False):
     """Get the copy number info for a given chromosome from a file."""
+    if cache:
+        # Series over memory-mapped slices; nothing is copied.
+        columns = sidecar.chrom_columns(filename, 'cn', chrom,
+                                        cn_columns, cache_dir_of(cache))
+        x = pd.Series(columns['start'], name = 'start')
+        depth = pd.Series(columns['CN'], name = 'CN')
+        return x, depth
+
     # Rewritten for .bed files
-    fields = ["chrom", "start", "end", "name", "CN"]
-    df = pd.read_csv(filename,
-                     sep = '\t',
-                     names = fields)
+    df = df_from_bed(filename)
     df_chrom = df[df['chrom'] == chrom]
     x = df_chrom['start']
     depth = df_chrom['CN']
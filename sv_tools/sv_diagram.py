@@ -2,8 +2,12 @@ import numpy as np
 
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
+import matplotlib.collections as collections
+from matplotlib.path import Path
 import matplotlib.gridspec as gridspec
 import matplotlib as mpl
+import matplotlib.figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.ticker import ScalarFormatter
 
 # Use Helvetica as the default font family
@@ -12,23 +16,39 @@ mpl.rcParams['font.size'] = 10.5
 
 from mpl_toolkits.axes_grid1 import ImageGrid, AxesGrid
 
+import sv_data
+
 fusion_type_color = {"D":  "#AC4142",
                      "TD": "#6A9FB5",
                      "HH": "#90A959",
                      "TT": "#AA759F"}.get
 
+# Where, and on which side of the dashed lines, fusion arcs are drawn.
+fusion_height = {"D": 4,
+                 "TD": 4,
+                 "HH": 2,
+                 "TT": 2}
+
+fusion_angles = {"D": (0, 180),
+                 "TD": (180, 0),
+                 "HH": (0, 180),
+                 "TT": (180, 0)}
+
 
 ### Campbell-grams ###
 
-def sv_diagram_axes():
-    """Set up a stacked pair of axes"""
+def sv_diagram_axes(fig = None):
+    """Set up a stacked pair of axes, on fig if given, or else on the
+       current pyplot figure."""
     gs = gridspec.GridSpec(2, 1,
                            height_ratios=[.8,1],
                            hspace = 0)
 
     gs.update(hspace = 0) # No gap between axes.
-    cn_axes = plt.subplot(gs[1])
-    fusion_axes = plt.subplot(gs[0], sharex = cn_axes)
+    if fig == None:
+        fig = plt.gcf()
+    cn_axes = fig.add_subplot(gs[1])
+    fusion_axes = fig.add_subplot(gs[0], sharex = cn_axes)
     return cn_axes, fusion_axes
 
 ## CN axes ##
@@ -69,7 +89,8 @@ def set_cn_axes_options(cn_axes, x, cn, kwargs):
     if kwargs.get("logbase", None) != None:
         cn_axes.set_yscale("log", basey = kwargs["logbase"])
         cn_axes.yaxis.set_major_formatter(ScalarFormatter())
-        plt.minorticks_off()
+        # As plt.minorticks_off(): this acts on the current axes.
+        cn_axes.figure.gca().minorticks_off()
 
     if (kwargs.get("xmin", None) != None) and (kwargs.get("xmax", None) != None):
         cn_axes.set_xlim(kwargs["xmin"], kwargs["xmax"])
@@ -104,9 +125,89 @@ def set_cn_axes_options(cn_axes, x, cn, kwargs):
     else:
         cn_axes.set_ylabel("Estimated copy number")
 
+cn_markersize = 1 # In points.
+
 def plot_cn(cn_axes, x, cn):
     """Plot copy number"""
-    cn_axes.plot(x, cn, 'o', markersize=1, color = 'black', alpha = .4)
+    cn_axes.plot(x, cn, 'o', markersize=cn_markersize, color = 'black',
+                 alpha = .4)
+
+def decimate_cn(x, cn, n_columns, n_rows,
+                xlim = None, ylim = None, logy = False):
+    """Reduces copy number points to at most one per cell of an
+       n_columns x n_rows grid spanning xlim and ylim (by default the
+       range of the data), on a log scale if logy. The lowest and
+       highest point of every column, and the first and last point, are
+       always kept. Points outside xlim, or not finite, are dropped.
+       Returns x and cn as arrays, in their original order."""
+
+    x = np.asarray(x, dtype = float)
+    cn = np.asarray(cn, dtype = float)
+
+    y = cn
+    if logy:
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            y = np.log(cn)
+    keep = np.isfinite(x) & np.isfinite(y)
+    if xlim != None:
+        keep &= (x >= xlim[0]) & (x <= xlim[1])
+    x, cn, y = x[keep], cn[keep], y[keep]
+    if len(x) == 0:
+        return x, cn
+
+    def cells(values, limits, n):
+        if limits is None:
+            lo, hi = values.min(), values.max()
+        else:
+            lo, hi = limits
+        scale = n / float(hi - lo) if hi > lo else 0
+        return np.clip(((values - lo) * scale).astype(np.int64), 0, n - 1)
+
+    if ylim != None and logy:
+        ylim = tuple(np.log(ylim))
+    column = cells(x, xlim, n_columns)
+    row = cells(y, ylim, n_rows)
+
+    # One point per occupied cell ...
+    occupied = np.unique(column * n_rows + row, return_index = True)[1]
+
+    # ... plus the extremes of each column ...
+    order = np.lexsort((y, column))
+    sorted_columns = column[order]
+    last = np.append(sorted_columns[1:] != sorted_columns[:-1], True)
+    first = np.append(True, last[:-1])
+    extremes = np.concatenate([order[first], order[last]])
+
+    # ... and the ends.
+    ends = [np.argmin(x), np.argmax(x)]
+
+    kept = np.unique(np.concatenate([occupied, extremes, ends]))
+    return x[kept], cn[kept]
+
+def axes_size_in_pixels(axes):
+    """Width and height of axes in output pixels."""
+    extent = axes.get_window_extent()
+    return extent.width, extent.height
+
+def decimate_cn_for_axes(cn_axes, x, cn, kwargs, cell_size = None):
+    """decimate_cn on a grid of cell_size x cell_size pixel cells over
+       cn_axes, given the plot_sv_diagram options in kwargs. By default
+       cells are half a CN marker across, since markers closer than
+       that cannot be told apart."""
+    if cell_size == None:
+        cell_size = cn_markersize * cn_axes.figure.dpi / 72. / 2
+    width, height = axes_size_in_pixels(cn_axes)
+    n_columns = max(1, int(width / cell_size))
+    n_rows = max(1, int(height / cell_size))
+
+    xlim, ylim = None, None
+    if (kwargs.get("xmin", None) != None) and (kwargs.get("xmax", None) != None):
+        xlim = (kwargs["xmin"], kwargs["xmax"])
+    if (kwargs.get("ymin", None) != None) and (kwargs.get("ymax", None) != None):
+        ylim = (kwargs["ymin"], kwargs["ymax"])
+    logy = kwargs.get("logbase", None) != None
+
+    return decimate_cn(x, cn, n_columns, n_rows, xlim, ylim, logy)
 
 ## Fusion axes ##
 
@@ -139,15 +240,8 @@ def plot_fusion(cn_axes, fusion_axes, fusion):
 
     fusion_type = fusion.type()
 
-    height = {"D": 4,
-              "TD": 4,
-              "HH": 2,
-              "TT": 2}
-
-    angles = {"D": (0, 180),
-              "TD": (180, 0),
-              "HH": (0, 180),
-              "TT": (180, 0)}
+    height = fusion_height
+    angles = fusion_angles
 
     ymin, ymax = cn_axes.get_ylim()
 
@@ -172,46 +266,125 @@ def plot_fusion(cn_axes, fusion_axes, fusion):
 
     fusion_axes.add_artist(e)
 
+def plot_fusions(cn_axes, fusion_axes, fusions):
+    """Plots a list of fusions (or an sv_data.FusionTable) as
+       plot_fusion would, but using one collection of arcs and one of
+       vertical lines per axes, drawn in the same order."""
+
+    data = sv_data.FusionTable.from_fusions(fusions).data
+    if len(data) == 0:
+        return
+
+    x1 = data['pos1'].values / 1e6
+    x2 = data['pos2'].values / 1e6
+    fusion_types = list(data['type'])
+    colors = [fusion_type_color(t) for t in fusion_types]
+    heights = np.array([fusion_height[t] for t in fusion_types])
+
+    ymin, ymax = cn_axes.get_ylim()
+
+    # Both breakpoints of each fusion in turn.
+    x_coords = np.column_stack([x1, x2]).ravel()
+    line_colors = [c for c in colors for _ in range(2)]
+
+    cn_axes.vlines(x_coords, ymin, ymax,
+                   colors = line_colors,
+                   alpha = 0.25)
+    fusion_axes.vlines(x_coords, 0, np.repeat(heights, 2),
+                       colors = line_colors,
+                       alpha = 0.25)
+
+    # The same Bezier arcs that patches.Arc draws, scaled and shifted
+    # into place.
+    unit_arcs = dict((t, Path.arc(*fusion_angles[t]))
+                     for t in set(fusion_types))
+    centres = (x1 + x2) / 2
+    half_widths = np.abs(x2 - x1) / 2
+
+    def arc_path(fusion_type, centre, half_width, height):
+        unit_arc = unit_arcs[fusion_type]
+        vertices = unit_arc.vertices * [half_width, .75] + [centre, height]
+        return Path(vertices, unit_arc.codes)
+
+    arcs = collections.PathCollection(
+                [arc_path(*args) for args in
+                 zip(fusion_types, centres, half_widths, heights)],
+                facecolors = 'none',
+                edgecolors = colors,
+                joinstyle = 'miter',
+                alpha = .7)
+
+    fusion_axes.add_collection(arcs, autolim = False)
+
 ## Putting it all together ##
 
-def setup_figure(width = 3.5, height = 3.3, dpi = 1000):
-    """Sets up the 'canvas'."""
-    fig = plt.figure()
+def setup_figure(width = 3.5, height = 3.3, dpi = 1000, pyplot = True):
+    """Sets up the 'canvas'. With pyplot = False, the figure is not
+       managed by pyplot, and draws with Agg; such figures can be used
+       safely outside the main process (see batch.py)."""
+    if pyplot:
+        fig = plt.figure()
+    else:
+        fig = mpl.figure.Figure()
+        FigureCanvasAgg(fig)
     fig.set_dpi(dpi)
     fig.set_figwidth(width)
     fig.set_figheight(height)
     return fig
 
-def plot_sv_diagram(x, cn, fusions, outfile, **kwargs):
-    """Plots a Campbell-gram with default-y settings.
-       Key word arguments are aesthetic options which can be
-       safely left blank:
-       xmin, xmax, ymin, ymax, xticks, yticks,
-       logbase, xlabel, ylabel
-    """
+def draw_sv_diagram(fig, x, cn, fusions, **kwargs):
+    """Draws a Campbell-gram on fig, which should be empty; see
+       plot_sv_diagram for the arguments. Returns the CN and fusion
+       axes."""
 
     # X axis is in Mb
     x = x / 1e6
 
-    fig = setup_figure()
-    cn_axes, fusion_axes = sv_diagram_axes()
+    cn_axes, fusion_axes = sv_diagram_axes(fig)
 
     # Copy number
 
-    plot_cn(cn_axes, x, cn)
+    # Only the points drawn are decimated; axis limits and the fusion
+    # axes still come from all the data, as without decimation.
+    decimate = kwargs.pop("decimate", False)
+    if decimate:
+        cell_size = None if decimate is True else decimate
+        plot_cn(cn_axes, *decimate_cn_for_axes(cn_axes, x, cn, kwargs,
+                                               cell_size))
+        points = np.column_stack([x, np.asarray(cn, dtype = float)])
+        cn_axes.update_datalim(points[np.isfinite(points).all(axis = 1)])
+        cn_axes.autoscale_view()
+    else:
+        plot_cn(cn_axes, x, cn)
 
     set_cn_axes_options(cn_axes, x, cn, kwargs)
     set_cn_axes_aesthetics(cn_axes)
-    plt.minorticks_off()
+    fig.gca().minorticks_off()
 
     # Fusions
 
     setup_fusion_axes(fusion_axes, min(x), max(x))
-    for fusion in fusions:
-        plot_fusion(cn_axes, fusion_axes, fusion)
+    plot_fusions(cn_axes, fusion_axes, fusions)
 
     # Ensure everything fits
-    plt.tight_layout()
+    fig.tight_layout()
+
+    return cn_axes, fusion_axes
+
+def plot_sv_diagram(x, cn, fusions, outfile, **kwargs):
+    """Plots a Campbell-gram with default-y settings.
+       fusions can be a list of Fusions or an sv_data.FusionTable.
+       Key word arguments are aesthetic options which can be
+       safely left blank:
+       xmin, xmax, ymin, ymax, xticks, yticks,
+       logbase, xlabel, ylabel
+       If decimate is set, copy number points that would be drawn on
+       top of each other are thinned out before plotting (see
+       decimate_cn_for_axes); a number gives the cell size in pixels.
+    """
+
+    fig = setup_figure()
+    draw_sv_diagram(fig, x, cn, fusions, **kwargs)
 
     # Output
 
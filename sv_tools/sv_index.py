@@ -0,0 +1,199 @@
+"""
+Per-chromosome indexes over breakpoints and fusions, for region queries
+such as "which breakpoints fall in chr12:60-70Mb".
+
+BreakpointIndex keeps breakpoint positions in a sorted array, so window
+and nearest-neighbour queries are binary searches. FusionIndex treats
+each intra-chromosomal fusion as the span [bp1.pos, bp2.pos] and finds
+overlapping spans with a centred interval tree (for spans containing
+the window start) plus a binary search (for spans starting inside it).
+"""
+
+import numpy as np
+
+### Breakpoints ###
+
+class BreakpointIndex(object):
+    """Sorted-array index of Breakpoints, e.g. from sv_data.breakpoints
+       or sv_data.get_breakpoints."""
+
+    def __init__(self, breakpoints):
+        by_chrom = {}
+        for bp in breakpoints:
+            by_chrom.setdefault(bp.chrom, []).append(bp)
+
+        self.positions = {}
+        self.breakpoints = {}
+        for chrom, bps in by_chrom.items():
+            bps = sorted(bps, key = lambda x: x.pos)
+            self.breakpoints[chrom] = bps
+            self.positions[chrom] = np.array([bp.pos for bp in bps])
+
+    @staticmethod
+    def from_table(fusion_table):
+        """Index the breakpoints of an sv_data.FusionTable."""
+        return BreakpointIndex(
+                    bp for fusion in fusion_table
+                       for bp in (fusion.bp1, fusion.bp2))
+
+    def chroms(self):
+        return sorted(self.positions)
+
+    def window_bounds(self, chrom, starts, ends):
+        """For arrays of window starts and ends (inclusive), returns
+           arrays lo, hi such that breakpoints lo:hi of chrom lie in each
+           window."""
+        positions = self.positions.get(chrom, np.array([]))
+        lo = np.searchsorted(positions, starts, side = 'left')
+        hi = np.searchsorted(positions, ends, side = 'right')
+        return lo, np.maximum(lo, hi)
+
+    def window(self, chrom, start, end):
+        """Breakpoints on chrom with start <= pos <= end, sorted by
+           position."""
+        lo, hi = self.window_bounds(chrom, start, end)
+        return self.breakpoints.get(chrom, [])[lo:hi]
+
+    def windows(self, chrom, starts, ends):
+        """Batched window(): a list of lists of Breakpoints."""
+        bps = self.breakpoints.get(chrom, [])
+        lo, hi = self.window_bounds(chrom, starts, ends)
+        return [bps[l:h] for l, h in zip(lo, hi)]
+
+    def counts(self, chrom, starts, ends):
+        """Number of breakpoints in each of many windows."""
+        lo, hi = self.window_bounds(chrom, starts, ends)
+        return hi - lo
+
+    def nearest_indices(self, chrom, positions):
+        """Indices (into the sorted breakpoints of chrom) of the
+           breakpoint nearest each position. Ties go to the left. Raises
+           ValueError if chrom has no breakpoints."""
+        sorted_positions = self.positions.get(chrom, np.array([]))
+        if len(sorted_positions) == 0:
+            raise ValueError("No breakpoints on chromosome %s" % chrom)
+        positions = np.asarray(positions)
+        right = np.searchsorted(sorted_positions, positions, side = 'left')
+        right = np.clip(right, 0, len(sorted_positions) - 1)
+        left = np.clip(right - 1, 0, len(sorted_positions) - 1)
+        left_closer = (np.abs(positions - sorted_positions[left]) <=
+                       np.abs(sorted_positions[right] - positions))
+        return np.where(left_closer, left, right)
+
+    def nearest(self, chrom, pos):
+        """The breakpoint on chrom nearest to pos, or None if chrom has
+           no breakpoints."""
+        if chrom not in self.breakpoints:
+            return None
+        return self.breakpoints[chrom][int(self.nearest_indices(chrom, pos))]
+
+    def nearest_many(self, chrom, positions):
+        """Batched nearest(): Nones if chrom has no breakpoints."""
+        if chrom not in self.breakpoints:
+            return [None] * len(positions)
+        bps = self.breakpoints[chrom]
+        return [bps[i] for i in self.nearest_indices(chrom, positions)]
+
+### Fusions ###
+
+def build_interval_tree(starts, ends, indices):
+    """Centred interval tree over the intervals indices. Each node is a
+       tuple (centre, starts ascending, indices by start,
+       ends ascending, indices by end, left, right)."""
+    if len(indices) == 0:
+        return None
+
+    centre = np.median(np.concatenate([starts[indices], ends[indices]]))
+    node_starts, node_ends = starts[indices], ends[indices]
+    here = indices[(node_starts <= centre) & (node_ends >= centre)]
+    left = indices[node_ends < centre]
+    right = indices[node_starts > centre]
+
+    by_start = here[np.argsort(starts[here], kind = 'mergesort')]
+    by_end = here[np.argsort(ends[here], kind = 'mergesort')]
+
+    return (centre,
+            starts[by_start], by_start,
+            ends[by_end], by_end,
+            build_interval_tree(starts, ends, left),
+            build_interval_tree(starts, ends, right))
+
+def stab(tree, point):
+    """Indices of the intervals in tree containing point."""
+    found = []
+    node = tree
+    while node != None:
+        centre, node_starts, by_start, node_ends, by_end, left, right = node
+        if point < centre:
+            found.append(by_start[:np.searchsorted(node_starts, point,
+                                                   side = 'right')])
+            node = left
+        elif point > centre:
+            found.append(by_end[np.searchsorted(node_ends, point,
+                                                side = 'left'):])
+            node = right
+        else:
+            found.append(by_start)
+            node = None
+    if found:
+        return np.concatenate(found)
+    else:
+        return np.array([], dtype = int)
+
+class FusionIndex(object):
+    """Index of intra-chromosomal fusions by the span between their
+       breakpoints, e.g. from sv_data.fusions or sv_data.get_fusions.
+       Fusions between chromosomes have no span and are not indexed."""
+
+    def __init__(self, fusions):
+        by_chrom = {}
+        for fusion in fusions:
+            if fusion.bp1.chrom == fusion.bp2.chrom:
+                by_chrom.setdefault(fusion.bp1.chrom, []).append(fusion)
+
+        self.fusions = {}
+        self.starts = {}
+        self.ends = {}
+        self.trees = {}
+        for chrom, fs in by_chrom.items():
+            fs = sorted(fs, key = lambda x: x.bp1.pos)
+            starts = np.array([f.bp1.pos for f in fs])
+            ends = np.array([f.bp2.pos for f in fs])
+            self.fusions[chrom] = fs
+            self.starts[chrom] = starts
+            self.ends[chrom] = ends
+            self.trees[chrom] = build_interval_tree(starts, ends,
+                                                    np.arange(len(fs)))
+
+    def chroms(self):
+        return sorted(self.fusions)
+
+    def overlapping_indices(self, chrom, start, end):
+        """Sorted indices of fusions on chrom whose span overlaps
+           [start, end]."""
+        if chrom not in self.fusions:
+            return np.array([], dtype = int)
+        # Spans containing start, plus spans starting in (start, end].
+        # These two sets are disjoint.
+        containing = stab(self.trees[chrom], start)
+        starts = self.starts[chrom]
+        lo = np.searchsorted(starts, start, side = 'right')
+        hi = np.searchsorted(starts, end, side = 'right')
+        starting = np.arange(lo, max(lo, hi))
+        return np.sort(np.concatenate([containing, starting]))
+
+    def overlapping(self, chrom, start, end):
+        """Fusions on chrom whose span overlaps [start, end], sorted by
+           the position of bp1."""
+        fs = self.fusions.get(chrom, [])
+        return [fs[i] for i in self.overlapping_indices(chrom, start, end)]
+
+    def overlapping_many(self, chrom, starts, ends):
+        """Batched overlapping(): a list of lists of Fusions."""
+        return [self.overlapping(chrom, start, end)
+                for start, end in zip(starts, ends)]
+
+    def within(self, chrom, start, end):
+        """Fusions on chrom with both breakpoints in [start, end]."""
+        return [f for f in self.overlapping(chrom, start, end)
+                if f.bp1.pos >= start and f.bp2.pos <= end]
@@ -0,0 +1,325 @@
+"""
+Identifiability sweeps over all rearrangements of a chromosome.
+
+The rearrangements are split into shards, one per retained subset of
+segments, and the clash classes of each shard (rearrangements with the
+same identifiability.adjacency_signature, and so the same
+sv_diagram_data) are found in a pool of worker processes. The signature
+includes the count of each segment, which is fixed by the shard, so
+classes never span shards.
+
+Shards differ greatly in size: the shard keeping every segment holds
+most rearrangements. Shards larger than max_shard_size are split into
+pieces by the first segments of their orders. A clash class can span
+pieces, so each piece spills its signatures to n_partitions files by
+signature hash, and each partition of the shard is then grouped in turn,
+also in the pool.
+
+Each finished shard, piece and partition is written to the sweep
+directory, so an interrupted sweep picks up where it left off when run
+again.
+
+    result = sweep.run_sweep("ABCDEFGH", "sweeps/ABCDEFGH", processes = 8)
+    print len(result.classes), result.n_rearrangements
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import multiprocessing
+import collections
+import cPickle as pickle
+
+import identifiability as idf
+
+SweepResult = collections.namedtuple('SweepResult',
+                                     ['classes', 'n_rearrangements',
+                                      'n_shards'])
+
+### Shards ###
+
+def shards(chrom_code):
+    """The retained subsets (sorted tuples of segment numbers) of the
+       rearrangements of a ChromCode, largest first."""
+    values = [abs(v) for v in chrom_code.values]
+    return [subset for k in range(len(values), -1, -1)
+                   for subset in idf.sub_multisets(values, k)]
+
+def n_orders(values):
+    """Number of distinct orders of a list of segment numbers."""
+    counts = collections.Counter(values).values()
+    n = 1
+    for i in range(2, len(values) + 1):
+        n *= i
+    for c in counts:
+        for i in range(2, c + 1):
+            n //= i
+    return n
+
+def estimated_size(subset, prefix = ()):
+    """Rough number of rearrangements of subset whose order starts with
+       prefix: each order, with each choice of orientations, counted
+       once with its reverse complement."""
+    rest = list(subset)
+    for v in prefix:
+        rest.remove(v)
+    return n_orders(rest) * 2 ** len(subset) // 2
+
+def pieces(subset, max_size):
+    """Prefixes splitting the rearrangements of subset into pieces of
+       at most about max_size: [()] if it does not need splitting.
+       Prefixes are lengthened one segment at a time, for all pieces of
+       the subset alike."""
+    prefixes = [()]
+    while (len(prefixes[0]) < len(subset) and
+           max(estimated_size(subset, p) for p in prefixes) > max_size):
+        longer = []
+        for p in prefixes:
+            rest = list(subset)
+            for v in p:
+                rest.remove(v)
+            longer.extend(p + (v,) for v in sorted(set(rest)))
+        prefixes = longer
+    return prefixes
+
+def subset_name(subset):
+    return "_".join(map(str, subset)) if subset else "empty"
+
+def shard_file(directory, subset, partition = None):
+    """The result file of a shard, or of one partition of a split
+       shard (partition is then a (partition, n_partitions) pair)."""
+    name = subset_name(subset)
+    if partition != None:
+        name += "_part%dof%d" % partition
+    return os.path.join(directory, "shard_%s.pickle" % name)
+
+def piece_dir(directory, subset, prefix):
+    """The directory of the partition files of a piece of a shard."""
+    return os.path.join(directory, "pieces_%s" % subset_name(subset),
+                        "prefix_%s" % subset_name(prefix))
+
+def result_files(directory, subset, prefixes, n_partitions):
+    if prefixes == [()]:
+        return [shard_file(directory, subset)]
+    return [shard_file(directory, subset, (p, n_partitions))
+            for p in range(n_partitions)]
+
+def shard_job(job):
+    """Clash classes of one shard, as (signature, canonical tuples)
+       pairs, and the number of rearrangements in the shard."""
+    subset, alphabet = job
+    buckets = collections.defaultdict(list)
+    n = 0
+    for code, key in idf.subset_signatures(subset, alphabet):
+        buckets[key].append(code.values)
+        n += 1
+    classes = [(key, members) for key, members in buckets.items()
+               if len(members) > 1]
+    return subset, n, classes
+
+def compact_key(subset, key):
+    """A signature of a rearrangement of subset, in a form much quicker
+       to pickle: the subset (which fixes the segment counts) and the
+       fusions, flattened in order."""
+    _, fusions = key
+    return (subset, tuple(end for fusion in sorted(fusions)
+                              for end in fusion))
+
+def piece_job(job):
+    """Signatures of one piece of a shard, spilled to n_partitions files
+       in its piece_dir (written under a temporary name first, so that a
+       piece directory is always complete). Returns the number of
+       rearrangements in the piece."""
+    subset, prefix, alphabet, directory, n_partitions = job
+    buckets = collections.defaultdict(list)
+    n = 0
+    for code, key in idf.subset_signatures(subset, alphabet, prefix):
+        buckets[key].append(code.values)
+        n += 1
+    buckets = dict((compact_key(subset, key), members)
+                   for key, members in buckets.items())
+
+    final = piece_dir(directory, subset, prefix)
+    parent = os.path.dirname(final)
+    try:
+        os.makedirs(parent)
+    except OSError:
+        if not os.path.isdir(parent):
+            raise
+    temporary = tempfile.mkdtemp(dir = parent)
+    idf.spill_buckets(buckets, temporary, n_partitions)
+    if os.path.isdir(final):
+        shutil.rmtree(final)
+    os.rename(temporary, final)
+    return subset, n, None
+
+def partition_job(job):
+    """Clash classes of one partition of a split shard, from the files
+       of all its pieces, and the number of rearrangements in it."""
+    subset, prefixes, partition, directory, n_partitions = job
+    buckets = collections.defaultdict(list)
+    for prefix in prefixes:
+        for key, members in idf.read_partition(
+                                piece_dir(directory, subset, prefix),
+                                partition):
+            buckets[key].extend(members)
+    n = sum(len(members) for members in buckets.values())
+    classes = [(key, members) for key, members in buckets.items()
+               if len(members) > 1]
+    return (subset, partition), n, classes
+
+def run_job(job):
+    kind, arguments = job
+    return {'shard': shard_job,
+            'piece': piece_job,
+            'partition': partition_job}[kind](arguments)
+
+def write_shard(filename, n, classes):
+    """Writes a finished shard (or partition), under a temporary name
+       first so that a shard file is always complete."""
+    handle, temporary = tempfile.mkstemp(dir = os.path.dirname(filename))
+    with os.fdopen(handle, 'wb') as f:
+        pickle.dump((n, classes), f, pickle.HIGHEST_PROTOCOL)
+    os.rename(temporary, filename)
+
+def read_shard(filename):
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+### Sweeps ###
+
+class Progress(object):
+    """Reports jobs done and rearrangements per second to a stream."""
+
+    def __init__(self, n_jobs, stream = sys.stderr, every = 1.):
+        self.n_jobs = n_jobs
+        self.stream = stream
+        self.every = every
+        self.done = 0
+        self.n_rearrangements = 0
+        self.start = time.time()
+        self.last = 0.
+
+    def update(self, n):
+        self.done += 1
+        self.n_rearrangements += n
+        now = time.time()
+        if (self.stream != None and
+                (now - self.last >= self.every or
+                 self.done == self.n_jobs)):
+            elapsed = now - self.start
+            rate = self.n_rearrangements / elapsed if elapsed > 0 else 0.
+            self.stream.write("%d/%d jobs, %d rearrangements, "
+                              "%.0f per second\n" %
+                              (self.done, self.n_jobs,
+                               self.n_rearrangements, rate))
+            self.stream.flush()
+            self.last = now
+
+def run_jobs(jobs, processes, finish):
+    """Runs jobs (see run_job), calling finish with each result as it
+       comes in. processes = 1 runs them in this process."""
+    if processes == 1:
+        for job in jobs:
+            finish(run_job(job))
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            for result in pool.imap_unordered(run_job, jobs):
+                finish(result)
+        finally:
+            pool.close()
+            pool.join()
+
+def run_sweep(chrom_string, directory, processes = None, alphabet = None,
+              progress = sys.stderr, max_shard_size = 100000,
+              n_partitions = 16):
+    """Finds the clash classes of all rearrangements of chrom_string (a
+       string such as "ABCDEFGH", or a ChromCode), checkpointing in
+       directory. Work already in directory is not redone. Shards of
+       more than about max_shard_size rearrangements are split into
+       pieces, whose classes are merged over n_partitions partitions.
+       processes = 1 runs in this process; None uses one process per
+       CPU. Progress is written to progress (None for silence), and
+       counts only the jobs run in this run. Returns a SweepResult,
+       whose n_shards counts pieces of split shards separately."""
+    if isinstance(chrom_string, idf.ChromCode):
+        chrom_code = chrom_string
+    else:
+        chrom_code = idf.ChromCode.from_string(chrom_string, alphabet)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    alphabet = chrom_code.alphabet
+
+    plan = [(subset, pieces(subset, max_shard_size))
+            for subset in shards(chrom_code)]
+
+    def done(subset, prefixes):
+        return all(os.path.exists(f) for f in
+                   result_files(directory, subset, prefixes, n_partitions))
+
+    first_jobs = []
+    second_jobs = []
+    for subset, prefixes in plan:
+        if done(subset, prefixes):
+            continue
+        if prefixes == [()]:
+            first_jobs.append(('shard', (subset, alphabet)))
+            continue
+        for prefix in prefixes:
+            if not os.path.isdir(piece_dir(directory, subset, prefix)):
+                first_jobs.append(('piece', (subset, prefix, alphabet,
+                                             directory, n_partitions)))
+        for partition in range(n_partitions):
+            filename = shard_file(directory, subset,
+                                  (partition, n_partitions))
+            if not os.path.exists(filename):
+                second_jobs.append(('partition',
+                                    (subset, prefixes, partition,
+                                     directory, n_partitions)))
+    tracker = Progress(len(first_jobs) + len(second_jobs), progress)
+
+    def finish_first(result):
+        subset, n, classes = result
+        if classes != None:
+            write_shard(shard_file(directory, subset), n, classes)
+        tracker.update(n)
+
+    def finish_second(result):
+        (subset, partition), n, classes = result
+        write_shard(shard_file(directory, subset, (partition, n_partitions)),
+                    n, classes)
+        tracker.update(0)
+
+    run_jobs(first_jobs, processes, finish_first)
+    run_jobs(second_jobs, processes, finish_second)
+
+    # The pieces of finished shards are no longer needed.
+    for subset, prefixes in plan:
+        pieces_dir = os.path.join(directory,
+                                  "pieces_%s" % subset_name(subset))
+        if os.path.isdir(pieces_dir) and done(subset, prefixes):
+            shutil.rmtree(pieces_dir)
+
+    files = [f for subset, prefixes in plan
+               for f in result_files(directory, subset, prefixes,
+                                     n_partitions)]
+    n_shards = sum(len(prefixes) for _, prefixes in plan)
+    return merge_shards(files, alphabet, n_shards)
+
+def merge_shards(files, alphabet = None, n_shards = None):
+    """Reads shard files back, merging classes by signature."""
+    merged = collections.defaultdict(set)
+    n_rearrangements = 0
+    for filename in files:
+        n, classes = read_shard(filename)
+        n_rearrangements += n
+        for key, members in classes:
+            # Made canonical again, in case the shard predates a change
+            # of canonical form.
+            merged[key].update(idf.ChromCode(m, alphabet) for m in members)
+    if n_shards == None:
+        n_shards = len(files)
+    return SweepResult(list(merged.values()), n_rearrangements, n_shards)
@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from sv_tools import sv_data
+
+header = ("##fileformat=VCFv4.2\n"
+          "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+
+def vcf_line(chrom, pos, alt, filter_value, info = "SVTYPE=BND"):
+    return "\t".join([chrom, str(pos), ".", "N", alt, ".",
+                      filter_value, info]) + "\n"
+
+class VcfFusionRowsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def rows(self, lines, **kwargs):
+        filename = os.path.join(self.directory, "test.vcf")
+        with open(filename, "w") as f:
+            f.write(header + "".join(lines))
+        return list(sv_data.vcf_fusion_rows(filename, **kwargs))
+
+    def test_mates_reported_once(self):
+        lines = [vcf_line("1", 100, "A[1:500[", "PASS"),
+                 vcf_line("1", 500, "]1:100]C", "PASS")]
+        expected = [("1", 100, "+", "1", 500, "-")]
+        self.assertEqual(self.rows(lines), expected)
+        self.assertEqual(self.rows(lines, pass_only = True), expected)
+
+    def test_mixed_filters_on_mates(self):
+        expected = [("1", 100, "+", "1", 500, "-")]
+        for lower, upper in [("LowQual", "PASS"), ("PASS", "LowQual")]:
+            lines = [vcf_line("1", 100, "A[1:500[", lower),
+                     vcf_line("1", 500, "]1:100]C", upper)]
+            self.assertEqual(self.rows(lines), expected)
+            self.assertEqual(self.rows(lines, pass_only = True), expected)
+            self.assertEqual(self.rows(lines, chrom = "1",
+                                       pass_only = True), expected)
+
+    def test_both_mates_filtered(self):
+        lines = [vcf_line("1", 100, "A[1:500[", "LowQual"),
+                 vcf_line("1", 500, "]1:100]C", "LowQual")]
+        self.assertEqual(self.rows(lines, pass_only = True), [])
+
+if __name__ == "__main__":
+    unittest.main()
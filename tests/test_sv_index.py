@@ -0,0 +1,37 @@
+import unittest
+
+from sv_tools import sv_data
+from sv_tools import sv_index
+
+def breakpoint(chrom, pos):
+    return sv_data.Breakpoint(chrom, pos, "+")
+
+class BreakpointIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = sv_index.BreakpointIndex([breakpoint("1", 100),
+                                               breakpoint("1", 300),
+                                               breakpoint("1", 200)])
+
+    def test_nearest(self):
+        self.assertEqual(self.index.nearest("1", 240), breakpoint("1", 200))
+        self.assertEqual(self.index.nearest("1", 250), breakpoint("1", 200))
+        self.assertEqual(self.index.nearest_many("1", [0, 260, 1000]),
+                         [breakpoint("1", 100), breakpoint("1", 300),
+                          breakpoint("1", 300)])
+
+    def test_chromosome_without_breakpoints(self):
+        self.assertEqual(self.index.window("2", 0, 1000), [])
+        self.assertEqual(self.index.nearest("2", 50), None)
+        self.assertEqual(self.index.nearest_many("2", [50, 60]),
+                         [None, None])
+        self.assertEqual(self.index.nearest_many("2", []), [])
+        self.assertRaises(ValueError, self.index.nearest_indices, "2", [50])
+
+    def test_empty_index(self):
+        index = sv_index.BreakpointIndex([])
+        self.assertEqual(index.nearest("1", 50), None)
+        self.assertEqual(index.window("1", 0, 1000), [])
+
+if __name__ == "__main__":
+    unittest.main()